@@ -0,0 +1,194 @@
+import numpy as np
+from numpy import ndarray
+
+from edge_layout import EdgeLayout, FreeEdgeSet, get_layout
+from game_action import GameAction
+from game_state import GameState
+
+
+class BitboardGameState(GameState):
+    """
+    Drop-in GameState that keeps the board in two python ints instead of three ndarrays.
+
+    edges: int
+        bit i is set when edge i (see EdgeLayout) was taken.
+
+    boxes: int
+        4 bits per box, box i at bits [4i, 4i + 4): the low 3 bits count the taken sides,
+        bit 3 is set when the value is negative (the last line was drawn by player1).
+        Decodes to exactly the values GameState keeps in board_status.
+
+    board_status, row_status and col_status are still available (read only) and are built on first
+    access, so agents written against GameState work unchanged.
+
+    The free edge set is only carried through apply/undo; generate_successor stays two int operations.
+    """
+    def __init__(self, layout: EdgeLayout, edges: int, boxes: int, player1_turn: bool):
+        self._layout = layout
+        self.edges = edges
+        self.boxes = boxes
+        self.player1_turn = player1_turn
+        self.extra_turn = False
+        self._undo_stack = None
+        self._arrays = None
+        self._free = None
+        self._zobrist = None
+
+    @classmethod
+    def from_arrays(cls, board_status: ndarray, row_status: ndarray, col_status: ndarray,
+                    player1_turn: bool) -> 'BitboardGameState':
+        layout = get_layout(*board_status.shape)
+        edges = 0
+        for e, (action_type, (x, y)) in enumerate(layout.edge_positions):
+            status = row_status if action_type == 'row' else col_status
+            if status[y, x] != 0:
+                edges |= 1 << e
+        boxes = 0
+        for b, value in enumerate(board_status.flat):
+            nibble = int(abs(value)) | (8 if value < 0 else 0)
+            boxes |= nibble << (4 * b)
+        return cls(layout, edges, boxes, bool(player1_turn))
+
+    @classmethod
+    def from_game_state(cls, state: GameState) -> 'BitboardGameState':
+        return cls.from_arrays(state.board_status, state.row_status, state.col_status, state.player1_turn)
+
+    def to_game_state(self) -> GameState:
+        board_status, row_status, col_status = self._build_arrays()
+        return GameState(board_status.copy(), row_status.copy(), col_status.copy(), self.player1_turn)
+
+    @property
+    def board_status(self) -> ndarray:
+        return self._get_arrays()[0]
+
+    @property
+    def row_status(self) -> ndarray:
+        return self._get_arrays()[1]
+
+    @property
+    def col_status(self) -> ndarray:
+        return self._get_arrays()[2]
+
+    def free_edges(self) -> FreeEdgeSet:
+        if self._free is None:
+            edges = self.edges
+            free = [e for e in self.layout.move_order if not (edges >> e) & 1]
+            self._free = FreeEdgeSet.from_edges(free, self.layout.num_edges)
+        return self._free
+
+    @property
+    def zobrist(self) -> int:
+        if self._zobrist is None:
+            layout = self.layout
+            keys = layout.zobrist_keys
+            edges = self.edges
+            zobrist = layout.zobrist_turn_key if self.player1_turn else 0
+            for e in range(layout.num_edges):
+                if (edges >> e) & 1:
+                    zobrist ^= keys[e]
+            self._zobrist = zobrist
+        return self._zobrist
+
+    def _next_zobrist(self, e: int, player1_turn: bool):
+        if self._zobrist is None:
+            return None
+        zobrist = self._zobrist ^ self.layout.zobrist_keys[e]
+        if player1_turn != self.player1_turn:
+            zobrist ^= self.layout.zobrist_turn_key
+        return zobrist
+
+    def _get_arrays(self):
+        if self._arrays is None:
+            self._arrays = self._build_arrays()
+            for array in self._arrays:
+                array.flags.writeable = False
+        return self._arrays
+
+    def _build_arrays(self):
+        layout = self.layout
+        board_status = np.zeros(shape=(layout.rows, layout.cols))
+        row_status = np.zeros(shape=(layout.rows + 1, layout.cols))
+        col_status = np.zeros(shape=(layout.rows, layout.cols + 1))
+
+        flat = board_status.reshape(-1)
+        for b in range(layout.num_boxes):
+            nibble = (self.boxes >> (4 * b)) & 15
+            flat[b] = -(nibble & 7) if nibble & 8 else (nibble & 7)
+
+        edges = self.edges
+        for e, (action_type, (x, y)) in enumerate(layout.edge_positions):
+            if (edges >> e) & 1:
+                if action_type == 'row':
+                    row_status[y, x] = 1
+                else:
+                    col_status[y, x] = 1
+        return board_status, row_status, col_status
+
+    def copy(self) -> 'BitboardGameState':
+        new_state = BitboardGameState(self.layout, self.edges, self.boxes, self.player1_turn)
+        new_state.extra_turn = self.extra_turn
+        new_state._zobrist = self._zobrist
+        if self._free is not None:
+            new_state._free = self._free.copy()
+        return new_state
+
+    def generate_successor(self, action: GameAction) -> 'BitboardGameState':
+        edges, boxes, player1_turn, points_scored = self._play(action)
+        new_state = BitboardGameState(self.layout, edges, boxes, player1_turn)
+        new_state.extra_turn = points_scored
+        new_state._zobrist = self._next_zobrist(self.layout.edge_of(action), player1_turn)
+        return new_state
+
+    def apply(self, action: GameAction) -> bool:
+        if self._undo_stack is None:
+            self._undo_stack = []
+        free_index = None
+        if self._free is not None:
+            e = self.layout.edge_of(action)
+            if e in self._free:
+                free_index = self._free.remove(e)
+        self._undo_stack.append((action, free_index, self._zobrist,
+                                 self.edges, self.boxes, self.player1_turn, self.extra_turn))
+        self.edges, self.boxes, player1_turn, self.extra_turn = self._play(action)
+        self._zobrist = self._next_zobrist(self.layout.edge_of(action), player1_turn)
+        self.player1_turn = player1_turn
+        self._arrays = None
+        return self.extra_turn
+
+    def undo(self):
+        (action, free_index, self._zobrist,
+         self.edges, self.boxes, self.player1_turn, self.extra_turn) = self._undo_stack.pop()
+        self._arrays = None
+        if free_index is not None and self._free is not None:
+            self._free.restore(self.layout.edge_of(action), free_index)
+        else:
+            self._free = None
+
+    def _play(self, action: GameAction):
+        layout = self.layout
+        e = layout.edge_of(action)
+
+        # same rule as GameState: every bordering box gets one more side and the mover's sign
+        sign = 8 if self.player1_turn else 0
+        boxes = self.boxes
+        points_scored = False
+        for b in layout.edge_boxes[e]:
+            shift = 4 * b
+            count = ((boxes >> shift) & 7) + 1
+            boxes = (boxes & ~(15 << shift)) | ((count | sign) << shift)
+            if count == 4:
+                points_scored = True
+
+        player1_turn = self.player1_turn if points_scored else not self.player1_turn
+        return self.edges | (1 << e), boxes, player1_turn, points_scored
+
+    def is_gameover(self):
+        return self.edges == self.layout.full_mask
+
+    def get_valid_moves(self):
+        edges = self.edges
+        actions = self.layout.actions
+        return [actions[e] for e in self.layout.move_order if not (edges >> e) & 1]
+
+    def count_valid_moves(self) -> int:
+        return self.layout.num_edges - self.edges.bit_count()
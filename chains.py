@@ -0,0 +1,236 @@
+from typing import Dict, List, Optional, Tuple
+
+from edge_layout import EdgeLayout
+from game_action import GameAction
+from game_state import GameState
+from symmetry import state_edges
+
+CHAIN = 'chain'
+LOOP = 'loop'
+
+GROUND = -1
+
+
+class Component:
+    """
+    A chain or a loop: a maximal group of uncaptured boxes with two or three sides taken, linked by the free
+    lines they share. Every box has at most two free lines, so a component is either a path (CHAIN) or a
+    closed cycle of 2-sided boxes (LOOP).
+
+    boxes: box ids (see EdgeLayout), ascending
+
+    open_ends: number of 3-sided boxes, the ones the player to move can capture right away. A loop has none;
+        taking a line inside a loop turns it into a chain with two open ends.
+
+    ends: for a chain, where its other ends lead: GROUND (the border of the board) or the id of the box with
+        two or more free lines the chain runs into. open_ends + len(ends) == 2 for every chain.
+    """
+    __slots__ = ('kind', 'boxes', 'open_ends', 'ends')
+
+    def __init__(self, kind: str, boxes: List[int], open_ends: int, ends: List[int]):
+        self.kind = kind
+        self.boxes = boxes
+        self.open_ends = open_ends
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def __repr__(self):
+        return f"Component({self.kind!r}, {self.boxes}, open_ends={self.open_ends}, ends={self.ends})"
+
+    @property
+    def is_loop(self) -> bool:
+        return self.kind == LOOP
+
+    @property
+    def capturable(self) -> bool:
+        return self.open_ends > 0
+
+
+class ChainAnalysis:
+    """
+    Every chain and loop of a position, found with a union-find over the boxes that have two or three sides
+    taken.
+
+    The analysis only depends on the taken lines, so it keeps its own copy of them (taken, sides) and
+    add_edge() updates it in place as lines are drawn: only the components touching the new line are
+    regrouped, the rest of the board is left alone.
+
+    component_of[b] is the component box b belongs to, None for boxes with fewer than two or all four sides
+    taken.
+    """
+    def __init__(self, layout: EdgeLayout, taken: int):
+        self.layout = layout
+        self.taken = taken
+        self.sides = [(taken & mask).bit_count() for mask in layout.box_masks]
+        self.component_of: List[Component] = [None] * layout.num_boxes
+        self.components: List[Component] = []
+        self._group([b for b in range(layout.num_boxes) if 2 <= self.sides[b] <= 3])
+
+    @classmethod
+    def from_state(cls, state: GameState) -> 'ChainAnalysis':
+        return cls(state.layout, state_edges(state))
+
+    def copy(self) -> 'ChainAnalysis':
+        new_analysis = ChainAnalysis.__new__(ChainAnalysis)
+        new_analysis.layout = self.layout
+        new_analysis.taken = self.taken
+        new_analysis.sides = self.sides.copy()
+        new_analysis.component_of = self.component_of.copy()
+        new_analysis.components = self.components.copy()
+        return new_analysis
+
+    def chains(self) -> List[Component]:
+        return [component for component in self.components if component.kind == CHAIN]
+
+    def loops(self) -> List[Component]:
+        return [component for component in self.components if component.kind == LOOP]
+
+    def capturable(self) -> List[Component]:
+        return [component for component in self.components if component.open_ends]
+
+    def add_edge(self, e: int):
+        """
+        Update the analysis after line e was drawn.
+        """
+        if (self.taken >> e) & 1:
+            return
+        self.taken |= 1 << e
+        touched = self.layout.edge_boxes[e]
+
+        affected = {id(self.component_of[b]): self.component_of[b] for b in touched if self.component_of[b]}
+        for b in touched:
+            self.sides[b] += 1
+        for b in touched:
+            if self.sides[b] == 2:
+                # b just stopped being a junction, so the components it leads to grow into it
+                for _, other in self.free_neighbours(b):
+                    component = self.component_of[other] if other != GROUND else None
+                    if component is not None:
+                        affected[id(component)] = component
+
+        boxes = set(b for b in touched if 2 <= self.sides[b] <= 3)
+        for component in affected.values():
+            for b in component.boxes:
+                self.component_of[b] = None
+                if self.sides[b] <= 3:
+                    boxes.add(b)
+        if affected:
+            self.components = [component for component in self.components if id(component) not in affected]
+        self._group(sorted(boxes))
+        # the order a full analysis has, so that ties (see endgame.py) are broken the same way
+        self.components.sort(key=lambda component: component.boxes[0])
+
+    def free_neighbours(self, b: int) -> List[Tuple[int, int]]:
+        """
+        (edge, box) for every free line of box b, box being the box on the other side of it or GROUND.
+        """
+        taken = self.taken
+        edge_boxes = self.layout.edge_boxes
+        neighbours = []
+        for e in self.layout.box_edges[b]:
+            if not (taken >> e) & 1:
+                boxes = edge_boxes[e]
+                if len(boxes) == 1:
+                    neighbours.append((e, GROUND))
+                else:
+                    neighbours.append((e, boxes[0] if boxes[1] == b else boxes[1]))
+        return neighbours
+
+    def _group(self, boxes: List[int]):
+        """
+        Union-find the given boxes (all with two or three sides taken and in no component yet) into
+        components and add them to the analysis.
+        """
+        if not boxes:
+            return
+        sides = self.sides
+        member = set(boxes)
+        parent = list(range(self.layout.num_boxes))
+        links = [0] * self.layout.num_boxes
+
+        def find(b):
+            while parent[b] != b:
+                parent[b] = parent[parent[b]]
+                b = parent[b]
+            return b
+
+        neighbours = {}
+        for b in boxes:
+            neighbours[b] = free = self.free_neighbours(b)
+            for _, other in free:
+                if other > b and other in member:
+                    root, other_root = find(b), find(other)
+                    if root != other_root:
+                        parent[other_root] = root
+                        links[root] += links[other_root]
+                    links[root] += 1
+
+        groups: Dict[int, List[int]] = {}
+        for b in boxes:
+            root = find(b)
+            if root in groups:
+                groups[root].append(b)
+            else:
+                groups[root] = [b]
+
+        for root, group in groups.items():
+            # a tree of n boxes has n - 1 links, one more closes the cycle
+            kind = LOOP if links[root] == len(group) else CHAIN
+            open_ends = sum(sides[b] == 3 for b in group)
+            ends = [other for b in group for _, other in neighbours[b] if other not in member]
+            component = Component(kind, group, open_ends, ends)
+            self.components.append(component)
+            for b in group:
+                self.component_of[b] = component
+
+
+_analyses: Dict[Tuple[int, int, int], ChainAnalysis] = {}
+_MAX_CACHED = 1 << 16
+# How far back analyze() looks along the apply() path for an analysis to update instead of starting over
+_MAX_REPLAY = 8
+
+
+def analyze(state: GameState) -> ChainAnalysis:
+    """
+    The (cached) ChainAnalysis of a state. Positions are cached by their taken lines, so the heuristics
+    calling this at every leaf pay for each position once. A position reached with apply() (a search) is
+    built from the closest cached position on its path with add_edge(), so the leaves below a node share
+    the work done for it. The result is shared: copy() it before calling add_edge().
+    """
+    layout = state.layout
+    taken = state_edges(state)
+    analysis = _analyses.get((layout.rows, layout.cols, taken))
+    if analysis is None:
+        analysis = _from_path(layout, taken, state.applied_actions())
+        if analysis is None:
+            analysis = ChainAnalysis(layout, taken)
+            _cache(analysis)
+    return analysis
+
+
+def _from_path(layout: EdgeLayout, taken: int, actions: List[GameAction]) -> Optional[ChainAnalysis]:
+    """
+    Walk back over the last actions (up to _MAX_REPLAY) to a cached position, then add the lines drawn since
+    to a copy of its analysis, caching every position on the way. None if no cached position is found.
+    """
+    path = []
+    for action in actions[:-_MAX_REPLAY - 1:-1]:
+        e = layout.edge_of(action)
+        path.append(e)
+        taken &= ~(1 << e)
+        analysis = _analyses.get((layout.rows, layout.cols, taken))
+        if analysis is not None:
+            for e in reversed(path):
+                analysis = analysis.copy()
+                analysis.add_edge(e)
+                _cache(analysis)
+            return analysis
+    return None
+
+
+def _cache(analysis: ChainAnalysis):
+    if len(_analyses) >= _MAX_CACHED:
+        _analyses.clear()
+    _analyses[(analysis.layout.rows, analysis.layout.cols, analysis.taken)] = analysis
@@ -0,0 +1,195 @@
+import random
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from game_action import GameAction
+
+
+class EdgeLayout:
+    """
+    Dense numbering of the edges and boxes of a board, shared by every state of the same size.
+
+    Edges: row lines come first, then column lines.
+        row (x, y) -> y * cols + x                      for y in [0, rows], x in [0, cols)
+        col (x, y) -> num_row_edges + y * (cols + 1) + x  for y in [0, rows), x in [0, cols]
+
+    Boxes: box (y, x) -> y * cols + x, matching board_status[y, x].
+
+    rows, cols are the dimensions of board_status (number of boxes).
+    """
+    def __init__(self, rows: int, cols: int):
+        self.rows = rows
+        self.cols = cols
+        self.num_boxes = rows * cols
+        self.num_row_edges = (rows + 1) * cols
+        self.num_col_edges = rows * (cols + 1)
+        self.num_edges = self.num_row_edges + self.num_col_edges
+        self.full_mask = (1 << self.num_edges) - 1
+
+        # edge id -> ('row' | 'col', (x, y))
+        self.edge_positions: List[Tuple[str, Tuple[int, int]]] = []
+        for y in range(rows + 1):
+            for x in range(cols):
+                self.edge_positions.append(('row', (x, y)))
+        for y in range(rows):
+            for x in range(cols + 1):
+                self.edge_positions.append(('col', (x, y)))
+
+        # edge id -> ids of the one or two boxes the edge borders
+        self.edge_boxes: List[Tuple[int, ...]] = []
+        for action_type, (x, y) in self.edge_positions:
+            boxes = []
+            if action_type == 'row':
+                if y >= 1:
+                    boxes.append((y - 1) * cols + x)
+                if y < rows:
+                    boxes.append(y * cols + x)
+            else:
+                if x >= 1:
+                    boxes.append(y * cols + x - 1)
+                if x < cols:
+                    boxes.append(y * cols + x)
+            self.edge_boxes.append(tuple(boxes))
+
+        # the same as an (num_edges, 2) array, padded with -1, for vectorized code
+        self.edge_box_array = np.array([boxes + (-1,) * (2 - len(boxes)) for boxes in self.edge_boxes])
+
+        # box id -> (top, bottom, left, right) edge ids
+        self.box_edges: List[Tuple[int, int, int, int]] = []
+        for y in range(rows):
+            for x in range(cols):
+                self.box_edges.append((self.edge_index('row', (x, y)),
+                                       self.edge_index('row', (x, y + 1)),
+                                       self.edge_index('col', (x, y)),
+                                       self.edge_index('col', (x + 1, y))))
+
+        # box id -> bitmask of its four edges
+        self.box_masks: List[int] = [sum(1 << e for e in edges) for edges in self.box_edges]
+
+        # One shared GameAction per edge; get_valid_moves hands these out instead of allocating new ones.
+        self.actions: List[GameAction] = [GameAction(action_type, position, e)
+                                          for e, (action_type, position) in enumerate(self.edge_positions)]
+
+        # The order GameState.get_valid_moves has always produced: rows column by column, then cols.
+        self.move_order: List[int] = (
+            [self.edge_index('row', (x, y)) for x in range(cols) for y in range(rows + 1)] +
+            [self.edge_index('col', (x, y)) for x in range(cols + 1) for y in range(rows)]
+        )
+        self._move_order_array = np.array(self.move_order)
+
+        # Zobrist keys: a state's hash is the xor of the keys of its taken edges, plus turn_key on player1's turn.
+        zobrist_random = random.Random(rows * 1000 + cols)
+        self.zobrist_keys: List[int] = [zobrist_random.getrandbits(64) for _ in range(self.num_edges)]
+        self.zobrist_turn_key: int = zobrist_random.getrandbits(64)
+        # per box, xored in for the boxes whose board_status is negative, for caches that need the whole board
+        self.zobrist_sign_keys: List[int] = [zobrist_random.getrandbits(64) for _ in range(self.num_boxes)]
+
+    def edge_index(self, action_type: str, position: Tuple[int, int]) -> int:
+        x, y = position
+        if action_type == 'row':
+            return y * self.cols + x
+        return self.num_row_edges + y * (self.cols + 1) + x
+
+    def edge_of(self, action: GameAction) -> int:
+        """
+        Edge id of an action, using the precomputed id when the action comes from this layout's table.
+        """
+        e = action.edge
+        if e is not None and e < self.num_edges and self.actions[e] is action:
+            return e
+        return self.edge_index(action.action_type, action.position)
+
+    def free_edges(self, row_status: np.ndarray, col_status: np.ndarray) -> List[int]:
+        """
+        Ids of the edges that are not taken in the given line arrays, in move_order.
+        """
+        taken = np.concatenate((row_status.reshape(-1), col_status.reshape(-1)))
+        order = self._move_order_array
+        return order[taken[order] == 0].tolist()
+
+
+_layouts: Dict[Tuple[int, int], EdgeLayout] = {}
+
+
+def get_layout(rows: int, cols: int) -> EdgeLayout:
+    """
+    Return the (cached) layout for a board with rows x cols boxes.
+    """
+    layout = _layouts.get((rows, cols))
+    if layout is None:
+        layout = EdgeLayout(rows, cols)
+        _layouts[(rows, cols)] = layout
+    return layout
+
+
+class FreeEdgeSet:
+    """
+    The untaken edges of a state, kept as a swap-remove array plus a position map so that counting,
+    removing, restoring and uniform sampling are O(1) and listing is O(k).
+
+    edges: int[]
+        the free edge ids, in no particular order
+
+    positions: int[]
+        positions[e] is the index of edge e in edges, -1 if e is taken
+    """
+    __slots__ = ('edges', 'positions')
+
+    def __init__(self, edges: List[int], positions: List[int]):
+        self.edges = edges
+        self.positions = positions
+
+    @classmethod
+    def from_edges(cls, free: List[int], num_edges: int) -> 'FreeEdgeSet':
+        positions = [-1] * num_edges
+        for i, e in enumerate(free):
+            positions[e] = i
+        return cls(list(free), positions)
+
+    def copy(self) -> 'FreeEdgeSet':
+        return FreeEdgeSet(self.edges.copy(), self.positions.copy())
+
+    def __len__(self):
+        return len(self.edges)
+
+    def __iter__(self):
+        return iter(self.edges)
+
+    def __contains__(self, e: int):
+        return self.positions[e] >= 0
+
+    def remove(self, e: int) -> int:
+        """
+        Remove edge e (must be free). Returns the index it had, to be passed back to restore().
+        """
+        edges = self.edges
+        positions = self.positions
+        index = positions[e]
+        last = edges.pop()
+        if last != e:
+            edges[index] = last
+            positions[last] = index
+        positions[e] = -1
+        return index
+
+    def restore(self, e: int, index: int):
+        """
+        Undo remove(e), putting every edge back at the index it had before.
+        """
+        edges = self.edges
+        positions = self.positions
+        if index == len(edges):
+            edges.append(e)
+        else:
+            moved = edges[index]
+            edges.append(moved)
+            positions[moved] = len(edges) - 1
+            edges[index] = e
+        positions[e] = index
+
+    def sample(self, rng=random) -> int:
+        """
+        A uniformly random free edge.
+        """
+        return self.edges[rng.randrange(len(self.edges))]
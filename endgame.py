@@ -0,0 +1,159 @@
+from typing import Dict, List, Optional, Tuple
+
+from chains import CHAIN, LOOP, ChainAnalysis, Component, analyze
+from game_action import GameAction
+from game_state import GameState
+
+
+def is_loony_endgame(analysis: ChainAnalysis) -> bool:
+    """
+    True when every box still to be taken has two or three sides taken. Then every free line gives a box
+    its 3rd side or completes one (there are no safe moves left) and the board is nothing but independent
+    chains and loops, every chain ending at the border of the board.
+
+    Loony positions with junction boxes (boxes with two or more free lines between chains) are not
+    covered, the agents keep searching those.
+    """
+    return all(sides >= 2 for sides in analysis.sides)
+
+
+def opening_value(key: Tuple[Tuple[str, int], ...]) -> int:
+    """
+    Net number of boxes the player to move gets out of a loony endgame with no capturable boxes, where
+    key is the sorted (kind, length) of its chains and loops.
+
+    The player to move has to open one of them, and the opponent then takes every box of it and opens the
+    next one himself, or keeps control: takes all but the last two boxes of a chain (all but four of a
+    loop) and hands those over with a double-dealing move. Chains are opened at their end, except 2-chains
+    which are opened in the middle (the hard-hearted handout) so they can't be declined.
+
+    The value only depends on the multiset of components, so it is memoized on key; a position with
+    counts c_1 .. c_k of k distinct (kind, length) takes prod(c_i + 1) evaluations at most.
+    """
+    value = _values.get(key)
+    if value is not None:
+        return value
+    if not key:
+        return 0
+    value = None
+    for i, (kind, length) in enumerate(key):
+        if i and key[i - 1] == (kind, length):
+            continue
+        opponent = _opponent_value(kind, length, opening_value(key[:i] + key[i + 1:]))
+        if value is None or -opponent > value:
+            value = -opponent
+    if len(_values) >= _MAX_CACHED:
+        _values.clear()
+    _values[key] = value
+    return value
+
+
+def solve(state: GameState) -> Optional[Tuple[int, GameAction]]:
+    """
+    Exact solution of a loony endgame (see is_loony_endgame): the net number of the remaining boxes the
+    player to move ends up with under perfect play, and a move that gets it. None for other positions.
+    """
+    analysis = analyze(state)
+    if not is_loony_endgame(analysis) or not analysis.components:
+        return None
+    opened = analysis.capturable()
+    closed = [component for component in analysis.components if not component.open_ends]
+    rest_value = opening_value(_key(closed))
+
+    if not opened:
+        best = None
+        for component in closed:
+            rest = list(closed)
+            rest.remove(component)
+            opponent = _opponent_value(component.kind, len(component), opening_value(_key(rest)))
+            if best is None or -opponent > best[0]:
+                best = (-opponent, component)
+        value, component = best
+        return value, state.layout.actions[_opening_edge(analysis, component)]
+
+    # Take everything that is offered, or keep control by declining the last boxes of one component
+    total = sum(len(component) for component in opened)
+    value, declined = total + rest_value, None
+    for component in opened:
+        kept = _kept_boxes(component.kind, len(component), opened=True, open_ends=component.open_ends)
+        if kept and total - 2 * kept - rest_value > value:
+            value, declined = total - 2 * kept - rest_value, component
+
+    for component in opened:
+        if component is not declined:
+            return value, state.layout.actions[_capturing_edge(analysis, component)]
+    kept = _kept_boxes(declined.kind, len(declined), opened=True, open_ends=declined.open_ends)
+    if len(declined) > kept:
+        return value, state.layout.actions[_capturing_edge(analysis, declined)]
+    return value, state.layout.actions[_double_dealing_edge(analysis, declined)]
+
+
+def _opponent_value(kind: str, length: int, rest_value: int) -> int:
+    """
+    What the opponent nets once a closed component is opened, rest_value being the opening_value of the
+    components left after it.
+    """
+    kept = _kept_boxes(kind, length, opened=False)
+    if kept:
+        return max(length + rest_value, length - 2 * kept - rest_value)
+    return length + rest_value
+
+
+def _kept_boxes(kind: str, length: int, opened: bool, open_ends: int = 0) -> int:
+    """
+    How many boxes a player keeping control hands back from a component, 0 if he can't keep control
+    through it. A closed component is the one the opponent is about to open, an opened one (open_ends > 0)
+    is what he left on the board.
+    """
+    if not opened:
+        if kind == LOOP:
+            return 4
+        return 2 if length >= 3 else 0
+    if open_ends == 1:
+        return 2 if length >= 2 else 0
+    # an opened loop, or a chain opened at both ends: two dominoes are left
+    return 4 if length >= 4 else 0
+
+
+def _key(components: List[Component]) -> Tuple[Tuple[str, int], ...]:
+    return tuple(sorted((component.kind, len(component)) for component in components))
+
+
+def _opening_edge(analysis: ChainAnalysis, component: Component) -> int:
+    """
+    The line that opens a closed component: the middle line of a 2-chain, a line at the end of any other
+    chain, any line of a loop.
+    """
+    if component.kind == CHAIN:
+        member = set(component.boxes)
+        for b in component.boxes:
+            for e, other in analysis.free_neighbours(b):
+                if (len(component) == 2) == (other in member):
+                    return e
+    return analysis.free_neighbours(component.boxes[0])[0][0]
+
+
+def _capturing_edge(analysis: ChainAnalysis, component: Component) -> int:
+    """
+    The line that completes a 3-sided box of an opened component.
+    """
+    for b in component.boxes:
+        if analysis.sides[b] == 3:
+            return analysis.free_neighbours(b)[0][0]
+
+
+def _double_dealing_edge(analysis: ChainAnalysis, component: Component) -> int:
+    """
+    The line that hands over the last two boxes of an opened chain (or four of an opened loop) as dominoes:
+    the one free line of the component that doesn't touch a 3-sided box.
+    """
+    open_boxes = set(b for b in component.boxes if analysis.sides[b] == 3)
+    for b in component.boxes:
+        if b not in open_boxes:
+            for e, other in analysis.free_neighbours(b):
+                if other not in open_boxes:
+                    return e
+
+
+_values: Dict[Tuple[Tuple[str, int], ...], int] = {}
+_MAX_CACHED = 1 << 16
@@ -1,10 +1,41 @@
-from typing import Literal, Tuple
+from typing import Literal, Optional, Tuple
 
 class GameAction:
     """
     action_type: "row" or "col" draws a horizontal or vertical line
     position: (x: int, y: int) position in grid, starting from (0, 0)
+    edge: dense edge id of the line (see EdgeLayout) for actions taken from a layout's action table,
+        None for actions built by hand.
+
+    Actions compare and hash by (action_type, position), so they can be used as dictionary keys
+    (Q-table, MCTS children) across states and games.
     """
-    def __init__(self, action_type: Literal["row", "col"], position: Tuple[int, int]):
+    __slots__ = ('action_type', 'position', 'edge', '_hash')
+
+    def __init__(self, action_type: Literal["row", "col"], position: Tuple[int, int], edge: Optional[int] = None):
         self.action_type = action_type
-        self.position = position
+        self.position = tuple(position)
+        self.edge = edge
+        self._hash = hash((action_type, self.position))
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, GameAction):
+            return NotImplemented
+        return self.action_type == other.action_type and self.position == other.position
+
+    def __hash__(self):
+        return self._hash
+
+    def __repr__(self):
+        return f"GameAction({self.action_type!r}, {self.position})"
+
+    def __reduce__(self):
+        return GameAction, (self.action_type, self.position)
+
+    def __setstate__(self, state):
+        # Q-tables pickled before GameAction had __slots__ store the attributes as a plain dict
+        if isinstance(state, tuple):
+            state = state[-1]
+        self.__init__(state['action_type'], state['position'])
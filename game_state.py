@@ -1,7 +1,10 @@
+import random
 from copy import deepcopy
 from typing import List
+import numpy as np
 from numpy import ndarray
 from game_action import GameAction
+from edge_layout import EdgeLayout, FreeEdgeSet, get_layout
 
 class GameState:
     NUM_OF_DOTS = None
@@ -21,21 +24,153 @@ class GameState:
 
     player1_turn: bool
         True if it is player 1 turn, False for player 2.
+
+    extra_turn: bool
+        True if the last move played into this state completed a box (so the same player moves again).
+
+    The free (untaken) edges are indexed lazily on first use (see free_edges()) and then kept up to date
+    by generate_successor/apply/undo. The same goes for the Zobrist hash (see zobrist).
     """
     def __init__(self, board_status: ndarray, row_status: ndarray, col_status: ndarray, player1_turn: bool):
         self.board_status = board_status
         self.row_status = row_status
         self.col_status = col_status
         self.player1_turn = player1_turn
+        self.extra_turn = False
+        self._undo_stack = None
+        self._layout = None
+        self._free = None
+        self._zobrist = None
 
-    def generate_successor(self, action: GameAction) -> 'GameState':
+    @property
+    def layout(self) -> EdgeLayout:
+        if self._layout is None:
+            self._layout = get_layout(*self.board_status.shape)
+        return self._layout
+
+    def free_edges(self) -> FreeEdgeSet:
+        """
+        The index of untaken edges, built from row_status/col_status the first time it is needed.
+        """
+        if self._free is None:
+            layout = self.layout
+            self._free = FreeEdgeSet.from_edges(layout.free_edges(self.row_status, self.col_status),
+                                                layout.num_edges)
+        return self._free
+
+    @property
+    def zobrist(self) -> int:
+        """
+        64 bit hash of the taken edges and whose turn it is (see EdgeLayout.zobrist_keys).
+        """
+        if self._zobrist is None:
+            layout = self.layout
+            keys = layout.zobrist_keys
+            zobrist = layout.zobrist_turn_key if self.player1_turn else 0
+            taken = np.concatenate((self.row_status.reshape(-1), self.col_status.reshape(-1)))
+            for e in np.flatnonzero(taken).tolist():
+                zobrist ^= keys[e]
+            self._zobrist = zobrist
+        return self._zobrist
+
+    def copy(self) -> 'GameState':
+        """
+        An independent copy of the state (the apply/undo history is not copied).
+        """
         new_state = GameState(
             self.board_status.copy(),
             self.row_status.copy(),
             self.col_status.copy(),
             self.player1_turn
         )
+        new_state.extra_turn = self.extra_turn
+        new_state._layout = self._layout
+        if self._free is not None:
+            new_state._free = self._free.copy()
+        new_state._zobrist = self._zobrist
+        return new_state
+
+    def generate_successor(self, action: GameAction) -> 'GameState':
+        new_state = self.copy()
+        new_state._play(action)
+        return new_state
+
+    def successor_stack(self, actions: List[GameAction]):
+        """
+        generate_successor for every action at once, as stacked arrays instead of GameState objects.
+        Returns (boards, rows, cols, player1_turns) with shapes (n, *board_status.shape), (n, *row_status.shape),
+        (n, *col_status.shape) and (n,).
+        """
+        layout = self.layout
+        n = len(actions)
+        children = np.arange(n)
+        edges = np.array([layout.edge_of(action) for action in actions], dtype=np.intp)
+
+        boards = np.repeat(self.board_status.reshape(1, -1), n, axis=0)
+        lines = np.repeat(np.concatenate((self.row_status.reshape(-1), self.col_status.reshape(-1)))[None], n, axis=0)
+        lines[children, edges] = 1
 
+        player_modifier = -1 if self.player1_turn else 1
+        points_scored = np.zeros(n, dtype=bool)
+        edge_boxes = layout.edge_box_array[edges]
+        for side in range(2):
+            has_box = edge_boxes[:, side] >= 0
+            rows_with_box = children[has_box]
+            boxes = edge_boxes[has_box, side]
+            values = (np.abs(boards[rows_with_box, boxes]) + 1) * player_modifier
+            boards[rows_with_box, boxes] = values
+            points_scored[rows_with_box] |= np.abs(values) == 4
+
+        player1_turns = np.where(points_scored, self.player1_turn, not self.player1_turn)
+        return (boards.reshape(n, layout.rows, layout.cols),
+                lines[:, :layout.num_row_edges].reshape(n, layout.rows + 1, layout.cols),
+                lines[:, layout.num_row_edges:].reshape(n, layout.rows, layout.cols + 1),
+                player1_turns)
+
+    def apply(self, action: GameAction) -> bool:
+        """
+        Play the action on this state in place (no copies). Returns True if it completed a box.
+        Every apply must be matched by an undo() to get the previous state back.
+        """
+        if self._undo_stack is None:
+            self._undo_stack = []
+        player1_turn = self.player1_turn
+        extra_turn = self.extra_turn
+        zobrist = self._zobrist
+        touched, free_index = self._play(action)
+        self._undo_stack.append((action, touched, free_index, zobrist, player1_turn, extra_turn))
+        return self.extra_turn
+
+    def applied_actions(self) -> List[GameAction]:
+        """
+        The actions played with apply() and not undone yet, oldest first.
+        """
+        return [entry[0] for entry in self._undo_stack or ()]
+
+    def undo(self):
+        """
+        Take back the last action played with apply().
+        """
+        action, touched, free_index, self._zobrist, self.player1_turn, self.extra_turn = self._undo_stack.pop()
+        x, y = action.position
+        if action.action_type == 'row':
+            self.row_status[y][x] = 0
+        elif action.action_type == 'col':
+            self.col_status[y][x] = 0
+        for box_y, box_x, value in touched:
+            self.board_status[box_y][box_x] = value
+        if free_index is not None and self._free is not None:
+            self._free.restore(self.layout.edge_of(action), free_index)
+        else:
+            # the index was built after this move was applied, so it cannot be rolled back
+            self._free = None
+
+    def _play(self, action: GameAction):
+        """
+        Draw the line, update the bordering boxes and pass the turn unless a box was completed.
+        Returns the (y, x, old value) of every box that was changed and the index the edge had in the
+        free edge set (None if the set isn't built).
+        """
         pointsScored = False
         logical_position = action.position
         type = action.action_type
@@ -44,44 +179,61 @@ class GameState:
 
         val = 1
         playerModifier = 1
-        if new_state.player1_turn:
+        if self.player1_turn:
             playerModifier = -1
 
-        if y < (GameState.NUM_OF_DOTS - 1) and x < (GameState.NUM_OF_DOTS - 1):
-            new_state.board_status[y][x] = (abs(new_state.board_status[y][x]) + val) * playerModifier
-            if abs(new_state.board_status[y][x]) == 4:
-                pointsScored = True
+        boxes = []
+        if y < self.board_status.shape[0] and x < self.board_status.shape[1]:
+            boxes.append((y, x))
 
         if type == 'row':
-            new_state.row_status[y][x] = 1
+            self.row_status[y][x] = 1
             if y >= 1:
-                new_state.board_status[y - 1][x] = (abs(new_state.board_status[y - 1][x]) + val) * playerModifier
-                if abs(new_state.board_status[y - 1][x]) == 4:
-                    pointsScored = True
+                boxes.append((y - 1, x))
 
         elif type == 'col':
-            new_state.col_status[y][x] = 1
+            self.col_status[y][x] = 1
             if x >= 1:
-                new_state.board_status[y][x - 1] = (abs(new_state.board_status[y][x - 1]) + val) * playerModifier
-                if abs(new_state.board_status[y][x - 1]) == 4:
-                    pointsScored = True
+                boxes.append((y, x - 1))
 
-        new_state.player1_turn = (not new_state.player1_turn) if not pointsScored else new_state.player1_turn
-        return new_state
+        touched = []
+        for box_y, box_x in boxes:
+            old_value = self.board_status[box_y][box_x]
+            touched.append((box_y, box_x, old_value))
+            self.board_status[box_y][box_x] = (abs(old_value) + val) * playerModifier
+            if abs(self.board_status[box_y][box_x]) == 4:
+                pointsScored = True
+
+        self.player1_turn = (not self.player1_turn) if not pointsScored else self.player1_turn
+        self.extra_turn = pointsScored
+
+        free_index = None
+        if self._free is not None:
+            e = self.layout.edge_of(action)
+            if e in self._free:
+                free_index = self._free.remove(e)
+        if self._zobrist is not None:
+            layout = self.layout
+            self._zobrist ^= layout.zobrist_keys[layout.edge_of(action)]
+            if not pointsScored:
+                self._zobrist ^= layout.zobrist_turn_key
+        return touched, free_index
 
     def is_gameover(self):
+        if self._free is not None:
+            return len(self._free) == 0
         return (self.row_status == 1).all() and (self.col_status == 1).all()
 
 
     def get_valid_moves(self):
-        valid_moves = []
-        for x in range(self.row_status.shape[1]):
-            for y in range(self.row_status.shape[0]):
-                if self.row_status[y, x] == 0:
-                    valid_moves.append(GameAction("row", (x, y)))
-        for x in range(self.col_status.shape[1]):
-            for y in range(self.col_status.shape[0]):
-                if self.col_status[y, x] == 0:
-                    valid_moves.append(GameAction("col", (x, y)))
-        return valid_moves
+        actions = self.layout.actions
+        return [actions[e] for e in self.free_edges()]
+
+    def count_valid_moves(self) -> int:
+        return len(self.free_edges())
 
+    def get_random_move(self, rng=random) -> GameAction:
+        """
+        A uniformly random valid move, in O(1).
+        """
+        return self.layout.actions[self.free_edges().sample(rng)]
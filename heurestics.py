@@ -1,4 +1,6 @@
 from game_state import GameState
+import endgame
+import nimstring
 import numpy as np
 from typing import Tuple, Literal
 
@@ -6,7 +8,8 @@ from typing import Tuple, Literal
 def combined(state: GameState):
     score = score_diff(state)
     chain_length_score = chain_len(state, start_box=3)
-    if chain_len(state,start_box=3) == 1 and chain_len(state,start_box=2) >= 1 and not check_for_free_boxes(state):
+    # chain_len doesn't depend on start_box, so one call stands for the three checks
+    if chain_length_score == 1 and not check_for_free_boxes(state):
         return -score
     return score - chain_length_score
 
@@ -79,28 +82,23 @@ def double_cross_evaluation(state: GameState):
 
 
 def detect_chain_length(state: GameState, x: int, y: int):
-    visited = set()
-    return _chain_length_dfs(state, x, y, visited)
-
-
-def _chain_length_dfs(state: GameState, x: int, y: int, visited: set):
-    if (x, y) in visited or abs(state.board_status[y, x]) != 3:
+    """
+    Number of 3-sided boxes connected to box (x, y) through neighbouring 3-sided boxes (whatever lines are
+    between them), 0 if (x, y) hasn't three sides taken.
+    """
+    sides = np.abs(state.board_status)
+    height, width = sides.shape
+    if sides[y, x] != 3:
         return 0
-
-    visited.add((x, y))
-    chain_length = 1  # Start with the current box
-
-    # Check neighboring boxes (up, down, left, right)
-    if y > 0:
-        chain_length += _chain_length_dfs(state, x, y - 1, visited)  # up
-    if y < state.board_status.shape[0] - 1:
-        chain_length += _chain_length_dfs(state, x, y + 1, visited)  # down
-    if x > 0:
-        chain_length += _chain_length_dfs(state, x - 1, y, visited)  # left
-    if x < state.board_status.shape[1] - 1:
-        chain_length += _chain_length_dfs(state, x + 1, y, visited)  # right
-
-    return chain_length
+    visited = {(x, y)}
+    stack = [(x, y)]
+    while stack:
+        x, y = stack.pop()
+        for nx, ny in ((x, y - 1), (x, y + 1), (x - 1, y), (x + 1, y)):
+            if 0 <= nx < width and 0 <= ny < height and (nx, ny) not in visited and sides[ny, nx] == 3:
+                visited.add((nx, ny))
+                stack.append((nx, ny))
+    return len(visited)
 
 
 def is_chain_opportunity(state: GameState, x: int, y: int):
@@ -122,72 +120,173 @@ def is_chain_opportunity(state: GameState, x: int, y: int):
     return neighboring_chains >= 2  # Consider it an opportunity if 2 or more neighboring chains exist
 
 
-def is_chain_of_2s(state, y, x, prev_y, prev_x):
-    """Check if the box at position (y, x) has exactly 2 sides filled."""
-    return abs(state.board_status[y][x]) == 2 and check_common_line_between_boxes(state, y, x, prev_y, prev_x)
-
-
-def check_common_line_between_boxes(game_state: GameState, y1: int, x1: int, y2: int, x2: int) -> bool:
+def chain_len(game_state: GameState, start_box=2) -> int:
     """
-    Checks if there's a common line between two adjacent boxes at coordinates (y1, x1) and (y2, x2).
+    The longest run found by a search that starts from every 3-sided box in row-major order (whatever
+    start_box is) and spreads to 2-sided neighbours, a box not being counted again once a run has taken it.
+    Two neighbours are linked when the left line of the left box (row_status: the top line of the upper box)
+    is taken, not the line between them, so runs are not the chains of chains.py.
     """
-    if y1 == y2:  # Boxes are horizontally adjacent
-        if x1 < x2:
-            return game_state.col_status[y1, x1] == 1  # Check the vertical line on the right
-        elif x1 > x2:
-            return game_state.col_status[y1, x2] == 1  # Check the vertical line on the left
-    elif x1 == x2:  # Boxes are vertically adjacent
-        if y1 < y2:
-            return game_state.row_status[y1, x1] == 1  # Check the horizontal line below
-        elif y1 > y2:
-            return game_state.row_status[y2, x1] == 1  # Check the horizontal line above
+    sides = np.abs(game_state.board_status)
+    height, width = sides.shape
+    right_links = (game_state.col_status[:, :-1] == 1).ravel().tolist()  # box b to b + 1
+    down_links = (game_state.row_status[:-1, :] == 1).ravel().tolist()  # box b to b + width
+    sides = sides.ravel().tolist()
+    visited = [False] * len(sides)
+    longest_chain = 0
+    for start, start_sides in enumerate(sides):
+        if start_sides != 3:
+            continue
+        chain_length = 0
+        stack = [start]
+        visited[start] = True
+        while stack:
+            b = stack.pop()
+            chain_length += 1
+            y, x = divmod(b, width)
+            for other, linked in ((b - width, y > 0 and down_links[b - width]),
+                                  (b + width, y < height - 1 and down_links[b]),
+                                  (b - 1, x > 0 and right_links[b - 1]),
+                                  (b + 1, x < width - 1 and right_links[b])):
+                if linked and not visited[other] and sides[other] == 2:
+                    visited[other] = True
+                    stack.append(other)
+        longest_chain = max(longest_chain, chain_length)
+    return longest_chain
 
-    return False
 
+# What winning Nimstring (getting control of the long chains) is worth in nimstring_evaluation
+NIMSTRING_CONTROL = 2
 
-def chain_len(game_state: GameState, start_box=2) -> int:
-    rows, cols = game_state.board_status.shape
-    visited = [[False for _ in range(cols)] for _ in range(rows)]
 
-    def dfs(y, x):
-        """Perform DFS to calculate the length of the chain starting from box (y, x)."""
-        stack = [(y, x)]
-        chain_length = 0
+def nimstring_evaluation(state: GameState):
+    """
+    score_diff plus NIMSTRING_CONTROL for the player who wins the Nimstring value of the position (see
+    nimstring.py), minus it for the other one. Positions too big for nimstring.py get plain score_diff, and
+    loony endgames get their exact final score (see endgame.py).
+    """
+    score = score_diff(state)
+    solution = endgame.solve(state)
+    if solution is not None:
+        return score + (solution[0] if state.player1_turn else -solution[0])
+    value = nimstring.nimstring_value(state)
+    if value is None:
+        return score
+    # a non-zero value (or LOONY) means the player to move wins
+    player1_wins = (value != 0) == state.player1_turn
+    return score + (NIMSTRING_CONTROL if player1_wins else -NIMSTRING_CONTROL)
 
-        while stack:
-            cur_y, cur_x = stack.pop()
-            if visited[cur_y][cur_x]:
-                continue
 
-            visited[cur_y][cur_x] = True
-            chain_length += 1
+# Batched versions of the heuristics above. They take the stacked arrays returned by
+# GameState.successor_stack (boards (n, rows, cols), row lines (n, rows + 1, cols), col lines (n, rows, cols + 1))
+# and return the (n,) values the per-state function would give for every state of the stack.
 
-            # Explore neighbors (up, down, left, right) that are part of the same chain of 2s
-            neighbors = []
-            if cur_y > 0 and not visited[cur_y - 1][cur_x] and is_chain_of_2s(game_state, cur_y - 1, cur_x, cur_y,
-                                                                              cur_x):
-                neighbors.append((cur_y - 1, cur_x))  # up
-            if cur_y < rows - 1 and not visited[cur_y + 1][cur_x] and is_chain_of_2s(game_state, cur_y + 1, cur_x,
-                                                                                     cur_y, cur_x):
-                neighbors.append((cur_y + 1, cur_x))  # down
-            if cur_x > 0 and not visited[cur_y][cur_x - 1] and is_chain_of_2s(game_state, cur_y, cur_x - 1, cur_y,
-                                                                              cur_x):
-                neighbors.append((cur_y, cur_x - 1))  # left
-            if cur_x < cols - 1 and not visited[cur_y][cur_x + 1] and is_chain_of_2s(game_state, cur_y, cur_x + 1,
-                                                                                     cur_y, cur_x):
-                neighbors.append((cur_y, cur_x + 1))  # right
-
-            stack.extend(neighbors)
-
-        return chain_length
+def score_diff_batch(boards: np.ndarray, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+    return (boards == -4).sum(axis=(1, 2)) - (boards == 4).sum(axis=(1, 2))
 
-    longest_chain = 0
 
-    for y in range(rows):
-        for x in range(cols):
-            if not visited[y][x] and abs(game_state.board_status[y][x]) == 3:
-                chain_length = dfs(y, x)
-                longest_chain = max(longest_chain, chain_length)
+def avoid_3rd_line_batch(boards: np.ndarray, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+    return (boards == -3).sum(axis=(1, 2)) - (boards == 3).sum(axis=(1, 2))
 
-    return longest_chain
 
+def chain_len_batch(boards: np.ndarray, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+    """
+    chain_len for a stack of states, without the per-box DFS.
+
+    chain_len starts a DFS from every 3-sided box (in row-major order) and walks 2-sided boxes linked as in
+    check_common_line_between_boxes: (y, x)-(y, x + 1) when col_status[y, x] is taken and (y, x)-(y + 1, x)
+    when row_status[y, x] is taken. Since visited is shared, every connected group of 2-sided boxes is counted
+    for the first 3-sided box (in scan order) it touches. So: label the groups, give each group to its first
+    3-sided neighbour, and the chain of a 3-sided box is 1 + the sizes of the groups it owns.
+    """
+    n, height, width = boards.shape
+    num_boxes = height * width
+    sides = np.abs(boards)
+    two = sides == 2
+    three = sides == 3
+    h_line = cols[:, :, :width - 1] == 1  # between (y, x) and (y, x + 1)
+    v_line = rows[:, :height - 1, :] == 1  # between (y, x) and (y + 1, x)
+
+    # connected groups of 2-sided boxes, labelled with the smallest box id in the group
+    none = num_boxes
+    labels = np.where(two, np.arange(num_boxes).reshape(height, width), none)
+    h_link = two[:, :, :-1] & two[:, :, 1:] & h_line
+    v_link = two[:, :-1, :] & two[:, 1:, :] & v_line
+    while True:
+        new_labels = labels.copy()
+        np.minimum(new_labels[:, :, :-1], np.where(h_link, labels[:, :, 1:], none), out=new_labels[:, :, :-1])
+        np.minimum(new_labels[:, :, 1:], np.where(h_link, labels[:, :, :-1], none), out=new_labels[:, :, 1:])
+        np.minimum(new_labels[:, :-1, :], np.where(v_link, labels[:, 1:, :], none), out=new_labels[:, :-1, :])
+        np.minimum(new_labels[:, 1:, :], np.where(v_link, labels[:, :-1, :], none), out=new_labels[:, 1:, :])
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+
+    # flat ids: group (i, label) -> i * (num_boxes + 1) + label, box (i, b) -> i * num_boxes + b
+    stride = num_boxes + 1
+    offsets = (np.arange(n) * stride).reshape(n, 1, 1)
+    group_ids = labels + offsets
+    sizes = np.bincount(group_ids[two], minlength=n * stride)
+
+    # owner of each group: the smallest id of a 3-sided box linked to it
+    box_ids = np.arange(num_boxes).reshape(1, height, width) + np.zeros((n, 1, 1), dtype=int)
+    owners = np.full(n * stride, num_boxes)
+    pairs = [(three[:, :, :-1] & two[:, :, 1:] & h_line, box_ids[:, :, :-1], group_ids[:, :, 1:]),
+             (two[:, :, :-1] & three[:, :, 1:] & h_line, box_ids[:, :, 1:], group_ids[:, :, :-1]),
+             (three[:, :-1, :] & two[:, 1:, :] & v_line, box_ids[:, :-1, :], group_ids[:, 1:, :]),
+             (two[:, :-1, :] & three[:, 1:, :] & v_line, box_ids[:, 1:, :], group_ids[:, :-1, :])]
+    for linked, starts, groups in pairs:
+        np.minimum.at(owners, groups[linked], starts[linked])
+
+    owned = owners < num_boxes
+    owner_ids = (np.arange(n * stride) // stride) * num_boxes + owners
+    chain = 1 + np.bincount(owner_ids[owned], weights=sizes[owned], minlength=n * num_boxes).reshape(n, num_boxes)
+    chain = np.where(three.reshape(n, num_boxes), chain, 0)
+    return chain.max(axis=1).astype(int)
+
+
+def chain_length_evaluation_batch(boards: np.ndarray, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+    return -chain_len_batch(boards, rows, cols)
+
+
+def combined_batch(boards: np.ndarray, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+    # combined's "return -score" branch needs a chain of length 1 (so a 3-sided box) while
+    # check_for_free_boxes finds no 3-sided box, which can't happen, so only score - chain length is left.
+    return score_diff_batch(boards, rows, cols) - chain_len_batch(boards, rows, cols)
+
+
+# Heuristics that are score_diff plus a function of the taken lines and the side to move only, so a search can
+# cache their values relative to the score (see AlphaBetaPlayer.alpha_beta_search). combined is one of them
+# because its "-score" branch is never taken: it needs chain_len 1, so a 3-sided box, and then
+# check_for_free_boxes finds that box.
+SCORE_RELATIVE = {score_diff, combined, nimstring_evaluation}
+
+
+def is_score_relative(evaluate) -> bool:
+    return evaluate in SCORE_RELATIVE
+
+
+# Heuristics that give the same value for rotated/reflected positions, so a search can share its cached values
+# across the symmetries of the board. chain_len (and so chain_length_evaluation and combined) is not: it walks
+# the boxes in row-major order and marks them visited along the way, so which chains it measures depends on
+# the orientation of the board.
+SYMMETRIC = {score_diff, avoid_3rd_line, nimstring_evaluation}
+
+
+def is_symmetric(evaluate) -> bool:
+    return evaluate in SYMMETRIC
+
+
+BATCH_EVALUATORS = {
+    score_diff: score_diff_batch,
+    avoid_3rd_line: avoid_3rd_line_batch,
+    chain_length_evaluation: chain_length_evaluation_batch,
+    combined: combined_batch,
+}
+
+
+def get_batch_evaluator(evaluate):
+    """
+    The batched version of a heuristic, or None if it only works one state at a time.
+    """
+    return BATCH_EVALUATORS.get(evaluate)
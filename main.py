@@ -1,12 +1,16 @@
 import argparse
 import os
 import pickle
+import time
 
 from players.expectimax_agent import ExpectimaxPlayer
 from players.monte_carlo_agent import MCTSPlayer
 from players.qlearning_agent import QLearningAgent
+from players.linear_q_agent import LinearQAgent
 from players.random_player import RandomPlayer
 from dots_and_boxes import Dots_and_Boxes
+from match_engine import initial_state, play_game
+from tournament import run_tournament, seed_game, summary
 from Renderers.gui_renderer import GUI_Renderer
 from Renderers.console_renderer import ConsoleRenderer
 from players.alpha_beta_agent import AlphaBetaPlayer
@@ -15,20 +19,25 @@ import heurestics
 from game_state import GameState
 
 
-def create_player(player_name, heurestic, depth=3, renderer=None, load_q_table=None):
+def create_player(player_name, heurestic, depth=3, renderer=None, load_q_table=None, tt_size_mb=0,
+                  use_symmetry=False, time_limit=None, workers=0, checkpoint_log=False, load_weights=None, seed=None):
     """
     Create player object based on the player name
     """
     if player_name == "Random":
         return RandomPlayer()
     elif player_name == "AlphaBeta":
-        return AlphaBetaPlayer(evaluate=heurestic, depth=depth)
+        return AlphaBetaPlayer(evaluate=heurestic, depth=depth, tt_size_mb=tt_size_mb, tt_symmetry=use_symmetry,
+                               time_limit=time_limit, workers=workers)
     elif player_name == "Expectimax":
         return ExpectimaxPlayer()
     elif player_name == "MCTS":
-        return MCTSPlayer()
+        return MCTSPlayer(workers=workers, time_limit=time_limit, seed=seed)
     elif player_name == "QLearning":
-        return QLearningAgent(q_table_file=load_q_table)  # Load Q-table if needed
+        return QLearningAgent(q_table_file=load_q_table, use_symmetry=use_symmetry,
+                              checkpoint_log=checkpoint_log)  # Load Q-table if needed
+    elif player_name == "LinearQ":
+        return LinearQAgent(weights_file=load_weights)
     elif player_name == "Human":
         return HumanPlayer(renderer)
     else:
@@ -47,23 +56,29 @@ def get_heurestic(hereustic):
         return heurestics.combined
     elif hereustic == "avoid_3rd_line":
         return heurestics.avoid_3rd_line
+    elif hereustic == "nimstring":
+        return heurestics.nimstring_evaluation
     else:
         raise ValueError(f"Invalid hereustic name: {hereustic}")
 
 
 def run(player1, player2, renderer, number_of_dots, games_num):
     """
-    Run the game
+    Run the game, then close() the players (which stops their worker processes)
     """
     if args.gui:
         game_instance = Dots_and_Boxes(renderer=renderer, games_num=games_num, number_of_dots=number_of_dots,
                                        player1=player1, player2=player2)
         game_instance.play()
+        player1.close()
+        player2.close()
         return
 
     score1 = 0
     score2 = 0
     tie = 0
+    results = []
+    start_time = time.time()
 
     if args.eval:
         if os.path.exists('eval_data.pkl'):
@@ -74,24 +89,34 @@ def run(player1, player2, renderer, number_of_dots, games_num):
 
     for i in range(games_num):
         print("Round:", i + 1)
-        game_instance = Dots_and_Boxes(renderer=renderer, games_num=1, number_of_dots=number_of_dots,
-                                       player1=player1, player2=player2)
-        game_instance.play()
-
-        score1 += game_instance.get_player1_score()
-        score2 += game_instance.get_player2_score()
-        tie += game_instance.get_tie()
+        if args.seed is not None:
+            seed_game(args.seed, i)
+        # player 1 starts the even games and player 2 the odd ones, as with --game_workers
+        final_state = initial_state(number_of_dots, i % 2 == 0)
+        game = play_game(player1, player2, final_state)
+        results.append(game)
+        print(f"Game ended. Player 1: {game.player1_score}, Player 2: {game.player2_score}")
+
+        score1 += game.winner == 1
+        score2 += game.winner == 2
+        tie += game.winner == 0
 
         if isinstance(player1, QLearningAgent):
-            result = 'win' if score1 > score2 else 'loss' if score1 < score2 else 'tie'
-            player1.reward(player1.round_end_reward(result))
+            result = 'win' if game.winner == 1 else 'loss' if game.winner == 2 else 'tie'
+            player1.reward(player1.round_end_reward(result), final_state)
             if args.load_q_table:
-                player1.save_q_table()
+                player1.checkpoint()
         if isinstance(player2, QLearningAgent):
-            result = 'win' if score2 > score1 else 'loss' if score2 < score1 else 'tie'
-            player2.reward(player2.round_end_reward(result))
+            result = 'win' if game.winner == 2 else 'loss' if game.winner == 1 else 'tie'
+            player2.reward(player2.round_end_reward(result), final_state)
             if args.load_q_table:
-                player2.save_q_table()
+                player2.checkpoint()
+
+        for player, is_player1 in ((player1, True), (player2, False)):
+            if isinstance(player, LinearQAgent):
+                player.finish_game(final_state, is_player1)
+                if args.load_weights:
+                    player.save_weights()
 
         if (i + 1) % 1000 == 0:
             e1 = eval_lst[-1][0]
@@ -101,11 +126,63 @@ def run(player1, player2, renderer, number_of_dots, games_num):
 
         print("---------------------------------------------------------------------------")
 
+    if args.load_q_table and args.checkpoint_log:
+        # compact the checkpoint logs into full snapshots
+        for player in (player1, player2):
+            if isinstance(player, QLearningAgent):
+                player.save_q_table()
+
+    if args.eval:
+        with open('eval_data.pkl', 'wb') as file:
+            pickle.dump(eval_lst, file)
+
+    player1.close()
+    player2.close()
+    print_results(score1, score2, tie, summary(results, time.time() - start_time))
+
+
+def run_parallel(player1_kwargs, player2_kwargs, number_of_dots, games_num):
+    """
+    Run the games over a pool of --game_workers processes (see tournament.py). Every game is seeded with
+    --seed and its number, and the players take turns to start. The players don't learn across games here,
+    so Q-tables and weights are not saved.
+    """
+    # The games are seeded one by one here. The MCTS seed is left out: its worker streams count the moves
+    # of all the games a player searched, which depends on how the games are split over the workers.
+    # The players search on one core each (no --workers): the game workers are the parallelism, and a
+    # player's own pool would keep its game worker from exiting (see tournament.run_tournament).
+    player1_kwargs = dict(player1_kwargs, seed=None, workers=0)
+    player2_kwargs = dict(player2_kwargs, seed=None, workers=0)
+    results, elapsed = run_tournament(create_player, player1_kwargs, player2_kwargs, number_of_dots, games_num,
+                                      args.game_workers, seed=0 if args.seed is None else args.seed)
+    score1 = sum(result.winner == 1 for result in results)
+    score2 = sum(result.winner == 2 for result in results)
+    tie = sum(result.winner == 0 for result in results)
+
     if args.eval:
+        if os.path.exists('eval_data.pkl'):
+            with open('eval_data.pkl', 'rb') as file:
+                eval_lst = pickle.load(file)
+        else:
+            eval_lst = [(0, 0, 0)]
+        wins1 = wins2 = ties = 0
+        for i, result in enumerate(results):
+            wins1 += result.winner == 1
+            wins2 += result.winner == 2
+            ties += result.winner == 0
+            if (i + 1) % 1000 == 0:
+                e1, e2, e3 = eval_lst[-1]
+                eval_lst.append((wins1 - e1, wins2 - e2, ties - e3))
         with open('eval_data.pkl', 'wb') as file:
             pickle.dump(eval_lst, file)
 
+    print_results(score1, score2, tie, summary(results, elapsed))
+
+
+def print_results(score1, score2, tie, summary_lines):
     print("---------------------------------------------------------------------------")
+    for line in summary_lines:
+        print(line)
     print("Final Results:")
     print(f"Player 1 ({args.player_1}): {score1}")
     print(f"Player 2 ({args.player_2}): {score2}")
@@ -118,15 +195,35 @@ if __name__ == "__main__":
     parser.add_argument("-s", "--board_size", type=int, default=4)
     parser.add_argument("-n", "--games_num", type=int, default=10)
     parser.add_argument("-p1", "--player_1", required=True,
-                        help="Choose from: Random, AlphaBeta, Expectimax, MCTS, QLearning, Human")
+                        help="Choose from: Random, AlphaBeta, Expectimax, MCTS, QLearning, LinearQ, Human")
     parser.add_argument("-p2", "--player_2", required=True,
-                        help="Choose from: Random, AlphaBeta, Expectimax, MCTS, QLearning, Human")
-    parser.add_argument('-h1', "--heuristic_1", default='score_diff', help="Choose from: score_diff, back_cross")
-    parser.add_argument('-h2', "--heuristic_2", default='score_diff', help="Choose from: score_diff, back_cross")
+                        help="Choose from: Random, AlphaBeta, Expectimax, MCTS, QLearning, LinearQ, Human")
+    parser.add_argument('-h1', "--heuristic_1", default='score_diff',
+                        help="Choose from: score_diff, chain_len, combined, avoid_3rd_line, nimstring")
+    parser.add_argument('-h2', "--heuristic_2", default='score_diff',
+                        help="Choose from: score_diff, chain_len, combined, avoid_3rd_line, nimstring")
     parser.add_argument("--gui", action="store_true", help="Enable GUI renderer instead of console")
-    parser.add_argument("--load_q_table", default='', help="path to Load Q-table for QLearningAgent")
+    parser.add_argument("--load_q_table", default='',
+                        help="path to Load Q-table for QLearningAgent, pickled or memory-mapped (see q_table_file.py)")
+    parser.add_argument("--load_weights", default='', help="path to Load weights (.npy) for LinearQAgent")
+    parser.add_argument("--checkpoint_log", action="store_true",
+                        help="save only the Q-values changed by each game, to a log next to the Q-table")
     parser.add_argument("--eval", action="store_true", help="save the results while training")
     parser.add_argument("--depth", type=int, default=3, help="file to save the results")
+    parser.add_argument("--time_limit", type=float, default=None,
+                        help="seconds per AlphaBeta/MCTS move (AlphaBeta deepens iteratively instead of using --depth)")
+    parser.add_argument("--tt_size_mb", type=float, default=0,
+                        help="memory cap (MB) of the AlphaBeta transposition table, 0 disables it")
+    parser.add_argument("--symmetry", action="store_true",
+                        help="share Q-table/transposition table entries between symmetric positions "
+                             "(AlphaBeta ignores it for the chain heuristics, which aren't symmetric)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="worker processes for the AlphaBeta/MCTS parallel search, 0 searches on one core")
+    parser.add_argument("--game_workers", type=int, default=0,
+                        help="worker processes to spread the games over (no --gui, --workers is ignored), "
+                             "0 plays them one after another")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="seed of every game and of the MCTS searches (0 by default with --game_workers)")
 
     args = parser.parse_args()
     number_of_dots = args.board_size + 1
@@ -142,8 +239,14 @@ if __name__ == "__main__":
     else:
         renderer = ConsoleRenderer(number_of_dots)
 
-    player1 = create_player(args.player_1, get_heurestic(args.heuristic_1), renderer=renderer, depth=args.depth,
-                            load_q_table=args.load_q_table)
-    player2 = create_player(args.player_2, get_heurestic(args.heuristic_2), renderer=renderer, depth=args.depth,
-                            load_q_table=args.load_q_table)
-    run(player1, player2, renderer, number_of_dots, games_num)
+    shared_kwargs = dict(depth=args.depth, load_q_table=args.load_q_table, tt_size_mb=args.tt_size_mb,
+                         use_symmetry=args.symmetry, time_limit=args.time_limit, workers=args.workers,
+                         checkpoint_log=args.checkpoint_log, load_weights=args.load_weights, seed=args.seed)
+    player1_kwargs = dict(player_name=args.player_1, heurestic=get_heurestic(args.heuristic_1), **shared_kwargs)
+    player2_kwargs = dict(player_name=args.player_2, heurestic=get_heurestic(args.heuristic_2), **shared_kwargs)
+    if args.game_workers and not args.gui:
+        run_parallel(player1_kwargs, player2_kwargs, number_of_dots, games_num)
+    else:
+        player1 = create_player(renderer=renderer, **player1_kwargs)
+        player2 = create_player(renderer=renderer, **player2_kwargs)
+        run(player1, player2, renderer, number_of_dots, games_num)
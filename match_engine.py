@@ -0,0 +1,85 @@
+import time
+
+import numpy as np
+
+from game_state import GameState
+from players.player import Player
+
+
+class MatchResult:
+    """
+    The outcome of one game.
+
+    player1_score, player2_score: boxes taken by each player
+    winner: 1 or 2, 0 for a tie
+    player1_moves, player2_moves: lines drawn by each player
+    player1_time, player2_time: seconds each player spent in get_action
+    """
+    __slots__ = ('player1_score', 'player2_score', 'winner', 'player1_moves', 'player2_moves', 'player1_time',
+                 'player2_time')
+
+    def __init__(self, player1_score: int, player2_score: int, player1_moves: int, player2_moves: int,
+                 player1_time: float, player2_time: float):
+        self.player1_score = player1_score
+        self.player2_score = player2_score
+        self.winner = 1 if player1_score > player2_score else 2 if player2_score > player1_score else 0
+        self.player1_moves = player1_moves
+        self.player2_moves = player2_moves
+        self.player1_time = player1_time
+        self.player2_time = player2_time
+
+    @property
+    def moves(self) -> int:
+        return self.player1_moves + self.player2_moves
+
+    def __repr__(self):
+        return f"MatchResult({self.player1_score}:{self.player2_score}, winner={self.winner}, moves={self.moves})"
+
+
+def initial_state(number_of_dots: int, player1_starts=True) -> GameState:
+    """
+    The empty board of a game, as Dots_and_Boxes starts it.
+    """
+    boxes = number_of_dots - 1
+    return GameState(np.zeros((boxes, boxes)), np.zeros((number_of_dots, boxes)), np.zeros((boxes, number_of_dots)),
+                     player1_starts)
+
+
+def play_game(player1: Player, player2: Player, state: GameState) -> MatchResult:
+    """
+    Play a game from state to the end with a plain loop: no renderer, no recursion. The same player may take
+    both seats (self play).
+
+    state is played in place, so the caller can look at the final position. Every player gets its own copy
+    of the position (players keep states around, the Q-learning agents for example), which brings the free
+    edge index and the Zobrist hash along. Scores and the end of the game are kept up to date move by move
+    from the boxes of the line drawn.
+    """
+    layout = state.layout
+    board = state.board_status
+    player1_score = int((board == -4).sum())
+    player2_score = int((board == 4).sum())
+    times = [0.0, 0.0]
+    moves = [0, 0]
+    moves_left = state.count_valid_moves()
+    while moves_left:
+        player1_turn = state.player1_turn
+        player = player1 if player1_turn else player2
+        if player.is_clickable():
+            raise ValueError(f"{player.get_player_name()} needs a renderer to play")
+        start = time.perf_counter()
+        action = player.get_action(state.copy())
+        times[0 if player1_turn else 1] += time.perf_counter() - start
+        moves[0 if player1_turn else 1] += 1
+
+        e = layout.edge_index(action.action_type, action.position)
+        if e not in state.free_edges():
+            raise ValueError(f"{player.get_player_name()} played {action}, which is not a free line")
+        state.apply(action)
+        moves_left -= 1
+        completed = sum(1 for b in layout.edge_boxes[e] if abs(board[divmod(b, layout.cols)]) == 4)
+        if player1_turn:
+            player1_score += completed
+        else:
+            player2_score += completed
+    return MatchResult(player1_score, player2_score, moves[0], moves[1], times[0], times[1])
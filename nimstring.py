@@ -0,0 +1,214 @@
+from typing import Dict, List, Optional, Tuple
+
+from game_state import GameState
+from symmetry import state_edges
+
+# A region is a group of uncaptured boxes linked by free lines. It is kept as a dict (y, x) -> free sides of
+# the box, a 4 bit mask in EdgeLayout.box_edges order: 1 top, 2 bottom, 4 left, 8 right. A free side with no
+# box of the region behind it leads to the ground (the border of the board).
+TOP, BOTTOM, LEFT, RIGHT = 1, 2, 4, 8
+SIDES = ((TOP, -1, 0, BOTTOM), (BOTTOM, 1, 0, TOP), (LEFT, 0, -1, RIGHT), (RIGHT, 0, 1, LEFT))  # side, dy, dx, opposite
+STEPS = {side: (dy, dx) for side, dy, dx, _ in SIDES}
+OPPOSITE = {side: opposite for side, _, _, opposite in SIDES}
+
+# Value of a position where a loony move was just made: the player to move wins Nimstring
+LOONY = -1
+
+# Regions with more free lines than this are not evaluated (the search over them grows as 2^lines)
+MAX_REGION_EDGES = 14
+
+Region = Dict[Tuple[int, int], int]
+RegionKey = Tuple[Tuple[int, int, int], ...]
+
+
+def nimstring_value(state: GameState) -> Optional[int]:
+    """
+    Nimstring value of the position for the player to move: the XOR of the nimbers of its regions, LOONY if
+    a loony move was just made, None when a region is too big to evaluate (see MAX_REGION_EDGES).
+
+    Nimstring is Dots and Boxes where whoever can't move loses, so the player who wins it (a non-zero
+    value for the player to move) is the one who gets control of the long chains in Dots and Boxes.
+    """
+    region = state_region(state)
+    if not _capture(region):
+        return LOONY
+    value = 0
+    for part in split(region):
+        if count_edges(part) > MAX_REGION_EDGES:
+            return None
+        value ^= nimber(canonical_key(part))
+    return value
+
+
+def state_region(state: GameState) -> Region:
+    """
+    All the uncaptured boxes of a state, with their free sides.
+    """
+    layout = state.layout
+    taken = state_edges(state)
+    region = {}
+    for b, edges in enumerate(layout.box_edges):
+        free = 0
+        for i, e in enumerate(edges):
+            if not (taken >> e) & 1:
+                free |= 1 << i
+        if free:
+            region[divmod(b, layout.cols)] = free
+    return region
+
+
+def nimber(key: RegionKey) -> int:
+    """
+    Sprague-Grundy value of a region without capturable boxes, memoized on its canonical key, so a region
+    that shows up again (anywhere on the board, rotated or reflected) costs a lookup.
+
+    The options are the lines of the region. A line that lets the opponent decline the boxes it offers is
+    a loony move, which loses, and isn't an option; the other boxes it offers are taken by the opponent
+    before he moves (see _capture).
+    """
+    value = _nimbers.get(key)
+    if value is not None:
+        return value
+    region = {(y, x): free for y, x, free in key}
+    options = set()
+    for (y, x), free in region.items():
+        for side, dy, dx, opposite in SIDES:
+            if not free & side:
+                continue
+            other = (y + dy, x + dx)
+            if other in region and other < (y, x):
+                continue  # the same line, seen from the other box
+            child = dict(region)
+            child[(y, x)] &= ~side
+            if other in child:
+                child[other] &= ~opposite
+            if not _capture(child):
+                continue
+            option = 0
+            for part in split(child):
+                option ^= nimber(canonical_key(part))
+            options.add(option)
+    value = 0
+    while value in options:
+        value += 1
+    if len(_nimbers) >= _MAX_CACHED:
+        _nimbers.clear()
+    _nimbers[key] = value
+    return value
+
+
+def split(region: Region) -> List[Region]:
+    """
+    The independent parts of a region: boxes only interact through the free lines between them.
+    """
+    parts = []
+    seen = set()
+    for start in region:
+        if start in seen:
+            continue
+        seen.add(start)
+        part = {}
+        stack = [start]
+        while stack:
+            y, x = stack.pop()
+            free = region[(y, x)]
+            part[(y, x)] = free
+            for side, dy, dx, _ in SIDES:
+                other = (y + dy, x + dx)
+                if free & side and other in region and other not in seen:
+                    seen.add(other)
+                    stack.append(other)
+        parts.append(part)
+    return parts
+
+
+def count_edges(region: Region) -> int:
+    count = 0
+    for (y, x), free in region.items():
+        for side, dy, dx, _ in SIDES:
+            if free & side and not ((y + dy, x + dx) in region and (y + dy, x + dx) < (y, x)):
+                count += 1
+    return count
+
+
+def canonical_key(region: Region) -> RegionKey:
+    """
+    The smallest of the keys of the region under the 8 rotations/reflections, each translated to (0, 0).
+    """
+    best = None
+    for transform in _TRANSFORMS:
+        cells = []
+        for (y, x), free in region.items():
+            new_free = 0
+            for side in (TOP, BOTTOM, LEFT, RIGHT):
+                if free & side:
+                    new_free |= _SIDE_MAPS[transform][side]
+            cells.append(transform(y, x) + (new_free,))
+        min_y = min(cell[0] for cell in cells)
+        min_x = min(cell[1] for cell in cells)
+        key = tuple(sorted((y - min_y, x - min_x, free) for y, x, free in cells))
+        if best is None or key < best:
+            best = key
+    return best
+
+
+def _capture(region: Region) -> bool:
+    """
+    Take the capturable (3-sided) boxes of the region in place, as the player to move does in Nimstring.
+    Returns False, leaving the region half captured, when one of them was offered with a loony move: the
+    end of a chain of two or more boxes, or of an opened loop of four or more, that the player to move can
+    also decline.
+    """
+    while True:
+        start = next((box for box, free in region.items() if free in (TOP, BOTTOM, LEFT, RIGHT)), None)
+        if start is None:
+            return True
+        if _is_loony(region, start):
+            return False
+        side = region.pop(start)
+        dy, dx = STEPS[side]
+        other = (start[0] + dy, start[1] + dx)
+        if other in region:
+            region[other] &= ~OPPOSITE[side]
+            if not region[other]:
+                del region[other]  # the line completed both boxes
+
+
+def _is_loony(region: Region, start: Tuple[int, int]) -> bool:
+    """
+    Whether the chain starting at the capturable box start can be declined: it runs through two or more
+    boxes to the ground or to a box with three or more free sides, or it is open at both ends and has
+    four or more boxes (two dominoes can be handed back).
+    """
+    length = 1
+    box, side = start, region[start]
+    while True:
+        dy, dx = STEPS[side]
+        box = (box[0] + dy, box[1] + dx)
+        if box not in region:
+            return length >= 2
+        free = region[box] & ~OPPOSITE[side]
+        sides = bin(region[box]).count('1')
+        if sides == 1:
+            return length + 1 >= 4
+        if sides >= 3:
+            return length >= 2
+        length += 1
+        side = free
+
+
+_TRANSFORMS = (
+    lambda y, x: (y, x), lambda y, x: (y, -x), lambda y, x: (-y, x), lambda y, x: (-y, -x),
+    lambda y, x: (x, y), lambda y, x: (x, -y), lambda y, x: (-x, y), lambda y, x: (-x, -y),
+)
+
+
+def _side_map(transform) -> Dict[int, int]:
+    by_step = {step: side for side, step in STEPS.items()}
+    return {side: by_step[transform(*STEPS[side])] for side in STEPS}
+
+
+_SIDE_MAPS = {transform: _side_map(transform) for transform in _TRANSFORMS}
+
+_nimbers: Dict[RegionKey, int] = {}
+_MAX_CACHED = 1 << 18
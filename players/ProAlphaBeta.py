@@ -1,4 +1,6 @@
 from typing import Tuple, Literal
+from chains import Component, analyze
+import endgame
 from players.player import Player
 from game_action import GameAction
 from game_state import GameState
@@ -40,6 +42,10 @@ class ProAlphaBetaPlayer(Player):
                 return (j+1,i), 'col'
 
     def get_action(self, state: GameState) -> GameAction:
+        solution = endgame.solve(state)
+        if solution is not None:
+            return solution[1]
+
         free_box = self.check_for_free_boxes(state)
         if free_box:
             return GameAction(free_box[1], free_box[0])
@@ -56,14 +62,15 @@ class ProAlphaBetaPlayer(Player):
         if depth == 0 or state.is_gameover():
             return self.evaluate(state), None
 
-        valid_moves = state.get_valid_moves(state)
+        valid_moves = state.get_valid_moves()
         best_move = None
 
         if maximizing_player:
             max_eval = -math.inf
             for action in valid_moves:
-                new_state = state.generate_successor(action)
-                eval_score, _ = self.alpha_beta_search(new_state, depth - 1, alpha, beta, False)
+                state.apply(action)
+                eval_score, _ = self.alpha_beta_search(state, depth - 1, alpha, beta, False)
+                state.undo()
                 if eval_score > max_eval:
                     max_eval = eval_score
                     best_move = action
@@ -74,8 +81,9 @@ class ProAlphaBetaPlayer(Player):
         else:
             min_eval = math.inf
             for action in valid_moves:
-                new_state = state.generate_successor(action)
-                eval_score, _ = self.alpha_beta_search(new_state, depth - 1, alpha, beta, True)
+                state.apply(action)
+                eval_score, _ = self.alpha_beta_search(state, depth - 1, alpha, beta, True)
+                state.undo()
                 if eval_score < min_eval:
                     min_eval = eval_score
                     best_move = action
@@ -112,31 +120,21 @@ class ProAlphaBetaPlayer(Player):
         return "Pro Alpha-Beta Player"
 
     def is_broken_chain_or_loop(self, state: GameState) -> bool:
-        # Check for broken chains or loops based on the state
-        state.evaluate_looney_state()
-        # Example: Check if any chains or loops match the criteria
-        for chain in state.chain_lengths:
-            if chain != 3:  # Handle chain not equal to 3
-                return True
-        for loop in state.independents:
-            if loop > 4:  # Handle loop greater than 4
-                return True
-        return False
+        # A chain or loop is broken once one of its boxes has three sides taken: its boxes are free to eat
+        return bool(analyze(state).capturable())
 
     def take_free_move(self, state: GameState) -> GameAction:
-        # Prioritize moves based on the criteria you described
-        if any(loop > 4 for loop in state.independents):
-            # Eat square from broken loop
-            return self.eat_square_from_structure(state, 'loop')
-        elif any(chain != 3 for chain in state.chain_lengths):
-            # Eat square from broken chain
-            return self.eat_square_from_structure(state, 'chain')
-        # Add further conditions based on priority
+        # Eat from broken loops first (they show up as chains open at both ends), then from broken chains
+        broken = sorted(analyze(state).capturable(), key=lambda component: -component.open_ends)
+        if broken:
+            return self.eat_square_from_structure(state, broken[0])
 
     def evaluate(self, state: GameState) -> int:
-        # Adjust evaluation based on Looney Value
-        if state.looney_value in [2, 4]:
-            return (3 / 4) * state.score_so_far  # Simplified looney evaluation
+        # Loony endgames are solved exactly: the score so far plus what the player to move nets from the rest
+        solution = endgame.solve(state)
+        if solution is not None:
+            remaining = solution[0] if not state.player1_turn else -solution[0]
+            return self.score_diff(state) + remaining
 
         return self._evaluate(state)
 
@@ -168,18 +166,7 @@ class ProAlphaBetaPlayer(Player):
         return (state.row_status == 1).all() and (state.col_status == 1).all()
 
     def get_all_possible_actions_legal(self, state: GameState):
-        actions = []
-        for y in range(state.row_status.shape[0]):
-            for x in range(state.row_status.shape[1]):
-                if state.row_status[y][x] == 0:
-                    actions.append(GameAction('row', (x, y)))
-
-        for y in range(state.col_status.shape[0]):
-            for x in range(state.col_status.shape[1]):
-                if state.col_status[y][x] == 0:
-                    actions.append(GameAction('col', (x, y)))
-
-        return actions
+        return state.get_valid_moves()
 
     def result(self, state: GameState, action: GameAction):
         # Simulate the action and return the new state
@@ -205,113 +192,32 @@ class ProAlphaBetaPlayer(Player):
 
         return new_state
 
-    def eat_square_from_structure(self, state: GameState, structure_type: str) -> GameAction:
+    def eat_square_from_structure(self, state: GameState, structure: Component) -> GameAction:
         """
-        This function will handle both chains and loops.
+        Take a box from a broken chain or loop.
         :param state: The current game state.
-        :param structure_type: Either 'chain' or 'loop'.
+        :param structure: A component of analyze(state) with open ends.
         :return: A GameAction representing the move to take.
         """
-        # Find the relevant structures (chains or loops)
-        structures = self.find_structures(state, structure_type)
-
-        if not structures:
-            return None  # No chains or loops found
+        analysis = analyze(state)
+        width = state.board_status.shape[1]
+        for box in structure.boxes:
+            if analysis.sides[box] == 3:
+                # the only unclaimed edge of the box
+                return self.get_unclaimed_edges(state, (box % width, box // width))[0]
 
-        # Select the first structure and the first uncompleted box in that structure
-        first_structure = structures[0]
-        for box_position in first_structure:
-            # Get the list of unclaimed edges for this box
-            unclaimed_edges = self.get_unclaimed_edges(state, box_position)
-            if unclaimed_edges:
-                # Take the first unclaimed edge
-                return unclaimed_edges[0]
-
-        return None  # Fallback, should never reach here if structures are found
+        return None  # Fallback, should never reach here for a broken structure
 
     def find_structures(self, state: GameState, structure_type: str):
         """
-        Generalized function to find either chains or loops.
-        :param state: The current game state.
-        :param structure_type: Either 'chain' or 'loop'.
-        :return: List of found structures.
-        """
-        structures = []
-        visited = set()
-
-        for y in range(state.board_status.shape[0]):
-            for x in range(state.board_status.shape[1]):
-                if (x, y) not in visited and self.is_part_of_structure(state, x, y, structure_type):
-                    # Start exploring the structure
-                    structure = self.explore_structure(state, x, y, visited, structure_type)
-                    if structure:
-                        structures.append(structure)
-        return structures
-
-    def is_part_of_structure(self, state: GameState, x: int, y: int, structure_type: str) -> bool:
-        """
-        Checks if a box is part of a structure (chain or loop).
-        :param state: The current game state.
-        :param x: The x-coordinate of the box.
-        :param y: The y-coordinate of the box.
-        :param structure_type: Either 'chain' or 'loop'.
-        :return: True if the box is part of the specified structure.
-        """
-        if structure_type == 'chain':
-            # A box is part of a chain if it has exactly 2 edges claimed
-            return state.board_status[y, x] == 2 or state.board_status[y, x] == -2
-        elif structure_type == 'loop':
-            # A box is part of a loop if it has exactly 3 edges claimed
-            return state.board_status[y, x] == 3 or state.board_status[y, x] == -3
-        return False
-
-    def explore_structure(self, state: GameState, x: int, y: int, visited: set, structure_type: str):
-        """
-        Generalized function to explore either chains or loops.
-        :param state: The current game state.
-        :param x: The x-coordinate of the starting box.
-        :param y: The y-coordinate of the starting box.
-        :param visited: Set of already visited boxes.
-        :param structure_type: Either 'chain' or 'loop'.
-        :return: A list representing the explored structure.
-        """
-        structure = []
-        stack = [(x, y)]
-
-        while stack:
-            current_x, current_y = stack.pop()
-            if (current_x, current_y) not in visited and self.is_part_of_structure(state, current_x, current_y,
-                                                                                   structure_type):
-                structure.append((current_x, current_y))
-                visited.add((current_x, current_y))
-                # Add neighboring boxes that are also part of the structure
-                neighbors = self.get_structure_neighbors(state, current_x, current_y, structure_type)
-                stack.extend(neighbors)
-
-        return structure
-
-    def get_structure_neighbors(self, state: GameState, x: int, y: int, structure_type: str):
-        """
-        Finds neighboring boxes that are part of the same structure (chain or loop).
+        Finds the chains or loops of the board.
         :param state: The current game state.
-        :param x: The x-coordinate of the current box.
-        :param y: The y-coordinate of the current box.
         :param structure_type: Either 'chain' or 'loop'.
-        :return: List of neighboring boxes that are part of the same structure.
+        :return: List of found structures, each a list of (x, y) box positions.
         """
-        neighbors = []
-        # Check all possible neighboring boxes (above, below, left, right)
-        if y > 0 and self.is_part_of_structure(state, x, y - 1, structure_type):  # Above
-            neighbors.append((x, y - 1))
-        if y < state.board_status.shape[0] - 1 and self.is_part_of_structure(state, x, y + 1,
-                                                                             structure_type):  # Below
-            neighbors.append((x, y + 1))
-        if x > 0 and self.is_part_of_structure(state, x - 1, y, structure_type):  # Left
-            neighbors.append((x - 1, y))
-        if x < state.board_status.shape[1] - 1 and self.is_part_of_structure(state, x + 1, y,
-                                                                             structure_type):  # Right
-            neighbors.append((x + 1, y))
-        return neighbors
+        width = state.board_status.shape[1]
+        return [[(box % width, box // width) for box in component.boxes]
+                for component in analyze(state).components if component.kind == structure_type]
 
     def get_unclaimed_edges(self, state: GameState, box_position: tuple) -> list:
         """
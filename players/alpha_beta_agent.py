@@ -1,55 +1,375 @@
 import random
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from players.player import Player
 from game_action import GameAction
 from game_state import GameState
+from transposition_table import TranspositionTable, EXACT, LOWER, UPPER
+from symmetry import get_symmetries
 import math
+import time
+import numpy as np
+import endgame
 import heurestics
 
 
+class SearchTimeout(Exception):
+    """
+    Raised inside the search when the time budget of the move is used up.
+    """
+
+
 class AlphaBetaPlayer(Player):
-    def __init__(self, depth=3, evaluate=heurestics.score_diff):
+    def __init__(self, depth=3, evaluate=heurestics.score_diff, tt_size_mb=0, tt_symmetry=False, time_limit=None,
+                 move_ordering=True, batch_leaves=True, endgame_solver=True, workers=0):
+        """
+        workers: number of worker processes for the fixed depth search (see parallel_search), 0 searches in
+            this process only. The workers are started on the first move and kept until close().
+        endgame_solver: once the position is a loony endgame (see endgame.is_loony_endgame), play the move of
+            the exact endgame solver instead of searching.
+        batch_leaves: when evaluate has a batched version (heurestics.get_batch_evaluator), score all the
+            children of a depth 1 node with one call over their stacked boards instead of one call per child.
+        move_ordering: search box-completing moves first, then safe moves, then sacrifices, using killer
+            moves and the history heuristic inside each group (see order_moves). Off, moves are only shuffled.
+        time_limit: seconds per move. When set, the search deepens one ply at a time (ignoring depth) and
+            plays the best move of the deepest search that finished in time.
+        tt_size_mb: memory cap of the transposition table in MB, 0 searches without one.
+        tt_symmetry: key the transposition table on the symmetry class of the position (see symmetry.py),
+            so rotated/reflected positions share entries. Ignored when evaluate can score the symmetric
+            positions differently (see heurestics.is_symmetric).
+
+        The transposition table keeps values relative to the score when evaluate is score_diff plus a function
+        of the lines and the side to move (see heurestics.is_score_relative), so transpositions with a
+        different split of the taken boxes share the entry. Other evaluators can depend on more of the board
+        (avoid_3rd_line looks at who drew the sides of a box), so their entries are keyed on the whole board.
+        """
         self.depth = depth
         self.evaluate = evaluate
+        self.transposition_table = TranspositionTable(tt_size_mb) if tt_size_mb else None
+        self.tt_symmetry = tt_symmetry and heurestics.is_symmetric(evaluate)
+        self.tt_score_relative = heurestics.is_score_relative(evaluate)
+        self.time_limit = time_limit
+        self.deadline = None
+        self.move_ordering = move_ordering
+        self.batch_evaluate = heurestics.get_batch_evaluator(evaluate) if batch_leaves else None
+        self.endgame_solver = endgame_solver
+        self.workers = workers
+        self.executor = None
+        self.root_bound = None  # the bound shared with the workers, best root value so far from the root side
+        # what a worker process needs to build its own copy of this player
+        self.worker_config = dict(depth=depth, evaluate=evaluate, tt_size_mb=tt_size_mb, tt_symmetry=self.tt_symmetry,
+                                  move_ordering=move_ordering, batch_leaves=batch_leaves,
+                                  endgame_solver=endgame_solver)
+        # In a worker: the best root value found so far by any worker, from the root player's side
+        self.shared_bound = None
+        self.root_maximizing = True
+        self.nodes_searched = 0
+        self.root_depth = depth
+        # Kept across the moves of a game, reset when a new game starts (see start_search)
+        self.history = None  # edge id -> accumulated depth^2 of the beta cutoffs it caused
+        self.killers = {}  # ply -> the last (up to) two moves that caused a beta cutoff at that ply
+        self.last_free_count = None
+
+    def start_search(self, state: GameState):
+        """
+        Reset the per-move counters, and the history/killer tables when the state belongs to a new game.
+        """
+        self.nodes_searched = 0
+        free_count = state.count_valid_moves()
+        if (self.history is None or len(self.history) != state.layout.num_edges or
+                self.last_free_count is None or free_count > self.last_free_count):
+            self.history = [0] * state.layout.num_edges
+            self.killers = {}
+        self.last_free_count = free_count
+        if self.transposition_table is not None:
+            self.transposition_table.new_search()
 
     def get_action(self, state: GameState) -> GameAction:
+        self.start_search(state)
+        if self.endgame_solver:
+            solution = endgame.solve(state)
+            if solution is not None:
+                return solution[1]
+        if self.time_limit is not None:
+            return self.iterative_deepening(state, self.time_limit)
+        if self.workers:
+            return self.parallel_search(state, self.depth)
         # Start Alpha-Beta Minimax
+        self.root_depth = self.depth
         score, best_action = self.alpha_beta_search(state, self.depth, -math.inf, math.inf)
         # print(f"Best action: {best_action.position}", f"Score: {score}")
         return best_action
 
+    def iterative_deepening(self, state: GameState, time_limit: float) -> GameAction:
+        """
+        Search depth 1, 2, ... until time_limit seconds have passed, trying the best move of the previous
+        depth first. Depth 1 always completes; a deeper search that runs out of time is thrown away.
+        """
+        start = time.perf_counter()
+        best_action = None
+        max_depth = state.count_valid_moves()
+        for depth in range(1, max_depth + 1):
+            self.deadline = start + time_limit if depth > 1 else None
+            self.root_depth = depth
+            # search a copy, an interrupted search leaves its moves applied
+            search_state = state.copy()
+            try:
+                score, action = self.alpha_beta_search(search_state, depth, -math.inf, math.inf,
+                                                       first_move=best_action)
+            except SearchTimeout:
+                break
+            finally:
+                self.deadline = None
+            best_action = action
+            if time.perf_counter() - start >= time_limit:
+                break
+        return best_action
+
+    def parallel_search(self, state: GameState, depth: int) -> GameAction:
+        """
+        Root split search: the first root move (in move order) is searched here to get a bound, then the
+        other root moves are searched by the worker processes at the same time. Every finished root move
+        raises the bound the workers share, and they tighten their windows with it at every node, so the
+        later subtrees still prune.
+
+        Returns the move the serial search would pick (the first one with the best value): a root move
+        whose search failed low against the shared bound can't be better than the move that set it.
+        """
+        if self.executor is None:
+            self.root_bound = multiprocessing.Value('d', -math.inf, lock=False)
+            self.executor = ProcessPoolExecutor(self.workers, initializer=_init_worker,
+                                                initargs=(self.worker_config, self.root_bound))
+        self.root_depth = depth
+        maximizing = state.player1_turn
+        sign = 1 if maximizing else -1
+        valid_moves = state.get_valid_moves()
+        random.shuffle(valid_moves)
+        if self.move_ordering:
+            self.order_moves(state, valid_moves, 0)
+
+        best_move = valid_moves[0]
+        state.apply(best_move)
+        best_value, _ = self.alpha_beta_search(state, depth - 1, -math.inf, math.inf)
+        state.undo()
+        self.root_bound.value = sign * best_value
+
+        futures = {self.executor.submit(_search_root_move, state.generate_successor(action), depth, maximizing): i
+                   for i, action in enumerate(valid_moves[1:], 1)}
+        results = [None] * len(valid_moves)
+        for future in as_completed(futures):
+            value, bound, nodes = future.result()
+            self.nodes_searched += nodes
+            results[futures[future]] = value, sign * value > bound
+            if sign * value > bound and sign * value > self.root_bound.value:
+                self.root_bound.value = sign * value
+
+        for action, result in zip(valid_moves[1:], results[1:]):
+            value, exact = result
+            if exact and sign * value > sign * best_value:
+                best_value, best_move = value, action
+        return best_move
+
+    def close(self):
+        """
+        Stop the worker processes of parallel_search.
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
     def get_player_name(self) -> str:
         return "AlphaBetaPlayer"
 
-    def alpha_beta_search(self, state: GameState, depth: int, alpha: float, beta: float):
+    def alpha_beta_search(self, state: GameState, depth: int, alpha: float, beta: float, first_move=None):
+        if self.deadline is not None and time.perf_counter() > self.deadline:
+            raise SearchTimeout()
+        self.nodes_searched += 1
         if depth == 0 or state.is_gameover():
             return self.evaluate(state), None
+        if self.shared_bound is not None:
+            # parallel_search worker: no line worse than the best root value found so far matters
+            bound = self.shared_bound.value
+            if self.root_maximizing:
+                alpha = max(alpha, bound)
+            else:
+                beta = min(beta, -bound)
+
+        table = self.transposition_table
+        table_move = None
+        if table is not None:
+            if self.tt_symmetry:
+                # entries are stored for the class representative, moves included
+                symmetries = get_symmetries(state.layout)
+                symmetry, key = symmetries.canonical_zobrist(state)
+            else:
+                symmetry, key = None, state.zobrist
+            if self.tt_score_relative:
+                # Values are stored relative to the score so far, so that transpositions reached with a
+                # different split of the already taken boxes share the entry.
+                base_score = heurestics.score_diff(state)
+            else:
+                key ^= self.board_signs_key(state, symmetry)
+                base_score = 0
+            entry = table.probe(key)
+            if entry is not None and entry[3] >= 0:
+                entry_depth, flag, value, move = entry
+                if self.tt_symmetry:
+                    move = symmetries.transform_edge(symmetries.inverse(symmetry), move)
+                if move in state.free_edges():
+                    table_move = state.layout.actions[move]
+                    value += base_score
+                    if entry_depth >= depth and (flag == EXACT or
+                                                 (flag == LOWER and value >= beta) or
+                                                 (flag == UPPER and value <= alpha)):
+                        return value, table_move
+            alpha_orig, beta_orig = alpha, beta
 
+        ply = self.root_depth - depth
         valid_moves = state.get_valid_moves()
         random.shuffle(valid_moves)
+        if self.move_ordering:
+            self.order_moves(state, valid_moves, ply)
+        for move in (table_move, first_move):
+            if move is not None and move in valid_moves:
+                valid_moves.remove(move)
+                valid_moves.insert(0, move)
         best_move = None
 
         maximizing_player = state.player1_turn
-        if maximizing_player:
-            max_eval = -math.inf
+        if depth == 1 and self.batch_evaluate is not None:
+            best_eval, best_move = self.evaluate_last_ply(state, valid_moves, alpha, beta, ply)
+        elif maximizing_player:
+            best_eval = -math.inf
             for action in valid_moves:
-                new_state = state.generate_successor(action)
-                eval_score, _ = self.alpha_beta_search(new_state, depth - 1, alpha, beta)
-                if eval_score > max_eval:
-                    max_eval = eval_score
+                state.apply(action)
+                eval_score, _ = self.alpha_beta_search(state, depth - 1, alpha, beta)
+                state.undo()
+                if eval_score > best_eval:
+                    best_eval = eval_score
                     best_move = action
                 alpha = max(alpha, eval_score)
                 if beta <= alpha:
+                    if self.move_ordering:
+                        self.record_cutoff(state, action, depth, ply)
                     break
-            return max_eval, best_move
         else:
-            min_eval = math.inf
+            best_eval = math.inf
             for action in valid_moves:
-                new_state = state.generate_successor(action)
-                eval_score, _ = self.alpha_beta_search(new_state, depth - 1, alpha, beta)
-                if eval_score < min_eval:
-                    min_eval = eval_score
+                state.apply(action)
+                eval_score, _ = self.alpha_beta_search(state, depth - 1, alpha, beta)
+                state.undo()
+                if eval_score < best_eval:
+                    best_eval = eval_score
                     best_move = action
                 beta = min(beta, eval_score)
                 if beta <= alpha:
+                    if self.move_ordering:
+                        self.record_cutoff(state, action, depth, ply)
                     break
-            return min_eval, best_move
+
+        if table is not None:
+            if best_eval <= alpha_orig:
+                flag = UPPER
+            elif best_eval >= beta_orig:
+                flag = LOWER
+            else:
+                flag = EXACT
+            move = state.layout.edge_of(best_move)
+            if self.tt_symmetry:
+                move = symmetries.transform_edge(symmetry, move)
+            table.store(key, depth, flag, best_eval - base_score, move)
+        return best_eval, best_move
+
+    @staticmethod
+    def board_signs_key(state: GameState, symmetry=None) -> int:
+        """
+        The xor of the zobrist sign keys of the boxes with a negative board_status, after symmetry (if any).
+        With the lines (which give the size of every box value) it pins down the whole board.
+        """
+        layout = state.layout
+        boxes = np.flatnonzero(state.board_status.reshape(-1) < 0).tolist()
+        if symmetry is not None:
+            box_perm = get_symmetries(layout).symmetries[symmetry].box_perm
+            boxes = [box_perm[b] for b in boxes]
+        key = 0
+        for b in boxes:
+            key ^= layout.zobrist_sign_keys[b]
+        return key
+
+    def evaluate_last_ply(self, state: GameState, valid_moves: list, alpha: float, beta: float, ply: int):
+        """
+        Score every child of a depth 1 node with a single batched evaluation. Returns the same
+        (value, move) as searching the children one by one (first best move in order wins ties).
+        """
+        boards, rows, cols, _ = state.successor_stack(valid_moves)
+        values = self.batch_evaluate(boards, rows, cols)
+        self.nodes_searched += len(valid_moves)
+        if state.player1_turn:
+            best = int(np.argmax(values))
+            cutoffs = np.flatnonzero(values >= beta)
+        else:
+            best = int(np.argmin(values))
+            cutoffs = np.flatnonzero(values <= alpha)
+        if self.move_ordering and len(cutoffs):
+            # the move the one-by-one search would have cut off on
+            self.record_cutoff(state, valid_moves[cutoffs[0]], 1, ply)
+        return values[best].item(), valid_moves[best]
+
+    def order_moves(self, state: GameState, valid_moves: list, ply: int):
+        """
+        Sort valid_moves in place, best first: moves that complete a box, then safe moves (no box gets its
+        3rd side), then sacrifices. Inside each group the killer moves of this ply come first and the rest
+        follow by history score. The sort is stable, so ties keep the (shuffled) order they came in.
+        """
+        layout = state.layout
+        edge_boxes = layout.edge_boxes
+        sides = np.abs(state.board_status).ravel().tolist()
+        killers = self.killers.get(ply, ())
+        history = self.history
+
+        def priority(action):
+            e = layout.edge_of(action)
+            group = 1  # safe
+            for b in edge_boxes[e]:
+                if sides[b] == 3:
+                    group = 2  # completes a box
+                    break
+                if sides[b] == 2:
+                    group = 0  # gives a box away
+            return (group, action in killers, history[e])
+
+        valid_moves.sort(key=priority, reverse=True)
+
+    def record_cutoff(self, state: GameState, action: GameAction, depth: int, ply: int):
+        """
+        Credit a move that caused a beta cutoff in the history table and keep it as a killer of its ply.
+        """
+        self.history[state.layout.edge_of(action)] += depth * depth
+        killers = self.killers.setdefault(ply, [])
+        if action not in killers:
+            killers.insert(0, action)
+            del killers[2:]
+
+
+# Worker process side of AlphaBetaPlayer.parallel_search. Each worker keeps one player (and with it its
+# transposition, killer and history tables) for as long as the pool lives.
+_worker_player = None
+
+
+def _init_worker(config: dict, bound):
+    global _worker_player
+    _worker_player = AlphaBetaPlayer(**config)
+    _worker_player.shared_bound = bound
+
+
+def _search_root_move(state: GameState, depth: int, maximizing: bool):
+    """
+    Search the position after a root move. Returns its value, the shared bound at the end of the search
+    (the value is exact only if it beats it) and the number of nodes searched.
+    """
+    player = _worker_player
+    player.start_search(state)
+    player.root_depth = depth
+    player.root_maximizing = maximizing
+    value, _ = player.alpha_beta_search(state, depth - 1, -math.inf, math.inf)
+    return value, player.shared_bound.value, player.nodes_searched
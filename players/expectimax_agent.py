@@ -4,13 +4,16 @@ import math
 from players.player import Player
 from game_action import GameAction
 from game_state import GameState
+import numpy as np
 import heurestics
 
 
 class ExpectimaxPlayer(Player):
-    def __init__(self, depth=3, evaluate=heurestics.score_diff):
+    def __init__(self, depth=3, evaluate=heurestics.score_diff, batch_leaves=True):
         self.depth = depth
         self.evaluate = evaluate
+        # score all the children of a depth 1 node with one call when the heuristic has a batched version
+        self.batch_evaluate = heurestics.get_batch_evaluator(evaluate) if batch_leaves else None
 
     def check_for_free_boxes(self, state: GameState) -> Tuple[Tuple[int, int], Literal['row', 'col']]:
         pos = None
@@ -58,11 +61,19 @@ class ExpectimaxPlayer(Player):
         best_move = None
 
         maximizing_player = state.player1_turn
+        if depth == 1 and self.batch_evaluate is not None:
+            boards, rows, cols, _ = state.successor_stack(valid_moves)
+            values = self.batch_evaluate(boards, rows, cols)
+            if maximizing_player:
+                best = int(np.argmax(values))
+                return values[best].item(), valid_moves[best]
+            return values.mean().item(), None
         if maximizing_player:
             max_eval = -math.inf
             for action in valid_moves:
-                new_state = state.generate_successor(action)
-                eval_score, _ = self.expectimax_search(new_state, depth - 1)
+                state.apply(action)
+                eval_score, _ = self.expectimax_search(state, depth - 1)
+                state.undo()
                 if eval_score > max_eval:
                     max_eval = eval_score
                     best_move = action
@@ -70,7 +81,8 @@ class ExpectimaxPlayer(Player):
         else:
             expected_value = 0
             for action in valid_moves:
-                new_state = state.generate_successor(action)
-                eval_score, _ = self.expectimax_search(new_state, depth - 1)
+                state.apply(action)
+                eval_score, _ = self.expectimax_search(state, depth - 1)
+                state.undo()
                 expected_value += eval_score / len(valid_moves)  # Taking the average of all possible outcomes
             return expected_value, None
@@ -0,0 +1,177 @@
+import os
+import random
+
+import numpy as np
+
+from chains import analyze
+from game_action import GameAction
+from game_state import GameState
+from players.player import Player
+
+FEATURES = ("bias", "completes", "creates_3_sided", "safe", "safe_left", "safe_parity", "sacrifice",
+            "lead", "free_left", "long_chains")
+
+
+def action_features(state: GameState):
+    """
+    Returns (edges, features): the free edge ids of the state and a (len(edges), len(FEATURES)) array with
+    the features of drawing each of them, all of them about the same size as 1:
+
+    bias: 1
+    completes: boxes the line completes (0, 1 or 2) / 2
+    creates_3_sided: boxes the line gives their 3rd side, that the opponent can take / 2
+    safe: 1 when the line neither completes nor creates a 3-sided box
+    safe_left: safe lines left after the line / num_edges
+    safe_parity: 1 when the safe lines left after the line are even (odd after a completing line, which is
+        followed by another move of the same player), -1 otherwise: with an even count the opponent is the
+        one who runs out of safe moves and has to open a chain
+    sacrifice: boxes of the chains/loops the line opens to the opponent / num_boxes, 0 unless it creates a
+        3-sided box without completing one
+    lead: the mover's score lead / num_boxes
+    free_left: free lines / num_edges
+    long_chains: chains of 3+ boxes and loops / num_boxes
+    """
+    layout = state.layout
+    edges = np.fromiter(state.free_edges(), dtype=np.intp)
+    # an extra box column absorbs the missing second box of the border edges, it never gets a side
+    ground = layout.num_boxes
+    edge_boxes = np.where(layout.edge_box_array >= 0, layout.edge_box_array, ground)
+    sides = np.zeros(ground + 1, dtype=np.int8)
+    sides[:ground] = np.abs(state.board_status).reshape(-1)
+
+    first, second = edge_boxes[edges].T
+    completes = (sides[first] == 3).astype(np.int8) + (sides[second] == 3)
+    creates = (sides[first] == 2).astype(np.int8) + (sides[second] == 2)
+    safe = (completes == 0) & (creates == 0)
+
+    # sides after each candidate line (one row per candidate), then which free lines stay safe
+    after = np.repeat(sides[None], len(edges), axis=0)
+    candidates = np.arange(len(edges))
+    after[candidates, first] += 1
+    after[candidates, second] += 1
+    after[:, ground] = 0
+    still_safe = np.maximum(after[:, first], after[:, second]) < 2
+    still_safe[candidates, candidates] = False
+    safe_left = still_safe.sum(axis=1)
+    parity = np.where(completes > 0, safe_left % 2 == 1, safe_left % 2 == 0)
+
+    analysis = analyze(state)
+    sacrifice = np.zeros(len(edges))
+    for i in np.flatnonzero((creates > 0) & (completes == 0)).tolist():
+        opened = {id(analysis.component_of[b]): len(analysis.component_of[b])
+                  for b in layout.edge_boxes[edges[i]] if sides[b] == 2 and analysis.component_of[b] is not None}
+        sacrifice[i] = sum(opened.values()) or 1
+
+    board = state.board_status
+    lead = int((board == -4).sum()) - int((board == 4).sum())
+    if not state.player1_turn:
+        lead = -lead
+    long_chains = sum(1 for component in analysis.components if component.is_loop or len(component) >= 3)
+
+    features = np.empty((len(edges), len(FEATURES)))
+    features[:, 0] = 1
+    features[:, 1] = completes / 2
+    features[:, 2] = creates / 2
+    features[:, 3] = safe
+    features[:, 4] = safe_left / layout.num_edges
+    features[:, 5] = np.where(parity, 1, -1)
+    features[:, 6] = sacrifice / layout.num_boxes
+    features[:, 7] = lead / layout.num_boxes
+    features[:, 8] = len(edges) / layout.num_edges
+    features[:, 9] = long_chains / layout.num_boxes
+    return edges, features
+
+
+class LinearQAgent(Player):
+    def __init__(self, learning_rate=0.05, discount_factor=1.0, epsilon=0.1, batch_size=32, weights_file=None,
+                 learning=True):
+        """
+        Q-learning with a linear Q-function, Q(s, a) = weights . action_features(s)[a], for boards too big for
+        a table: the agent keeps len(FEATURES) weights and one batch of transitions, whatever the board size
+        and however long it trains, and scores every legal action with one matrix-vector product.
+
+        A transition goes from one of the agent's moves to its next one (or the end of the game), the reward
+        being the change of its score lead in between, so the Q-values estimate the net boxes still to come.
+        The TD targets r + discount_factor * max Q(s') are collected into a batch of batch_size and the
+        weights follow the semi-gradient of the squared TD error of the whole batch at once.
+
+        finish_game(final_state) closes the last transition of a game; without it the transition is dropped
+        when the next game starts.
+
+        weights_file: .npy file to load the weights from (see save_weights).
+        learning: off, the agent only plays (no batches are collected).
+        """
+        self.learning_rate = learning_rate
+        self.discount_factor = discount_factor
+        self.epsilon = epsilon
+        self.learning = learning
+        self.weights_file = weights_file
+        self.weights = np.zeros(len(FEATURES))
+        self.batch_features = np.zeros((batch_size, len(FEATURES)))
+        self.batch_targets = np.zeros(batch_size)
+        self.batch_count = 0
+        self.updates = 0
+        # the features of the last move and the lead before it, until the agent's next move gives its target
+        self.pending = None
+        self.last_free_count = None
+        if weights_file:
+            self.load_weights()
+
+    def get_action(self, state: GameState) -> GameAction:
+        edges, features = action_features(state)
+        q_values = features @ self.weights
+        if self.learning:
+            if self.last_free_count is not None and len(edges) > self.last_free_count:
+                self.pending = None  # a new game started before finish_game was called
+            self.last_free_count = len(edges)
+            if self.pending is not None:
+                self.add_transition(features[0, 7], q_values.max())
+        if random.random() < self.epsilon:
+            i = random.randrange(len(edges))
+        else:
+            i = int(q_values.argmax())
+        if self.learning:
+            self.pending = (features[i], features[i, 7], state.layout.num_boxes)
+        return state.layout.actions[edges[i]]
+
+    def finish_game(self, final_state: GameState, player1: bool):
+        """
+        Close the last transition of a finished game, the agent playing as player1 or player2.
+        """
+        if self.learning and self.pending is not None:
+            board = final_state.board_status
+            lead = int((board == -4).sum()) - int((board == 4).sum())
+            self.add_transition((lead if player1 else -lead) / final_state.layout.num_boxes, 0.0)
+        self.pending = None
+        self.last_free_count = None
+
+    def add_transition(self, lead: float, next_value: float):
+        """
+        Complete the pending transition with the lead (per box, see action_features) reached and the value of
+        the position reached, and update the weights when the batch is full.
+        """
+        features, last_lead, num_boxes = self.pending
+        reward = (lead - last_lead) * num_boxes
+        self.batch_features[self.batch_count] = features
+        self.batch_targets[self.batch_count] = reward + self.discount_factor * next_value
+        self.batch_count += 1
+        self.pending = None
+        if self.batch_count == len(self.batch_targets):
+            errors = self.batch_targets - self.batch_features @ self.weights
+            self.weights += self.learning_rate * (self.batch_features.T @ errors) / self.batch_count
+            self.batch_count = 0
+            self.updates += 1
+
+    def save_weights(self):
+        with open(self.weights_file, 'wb') as file:
+            np.save(file, self.weights)
+
+    def load_weights(self):
+        if os.path.exists(self.weights_file):
+            self.weights = np.load(self.weights_file)
+            print(f"Weights loaded from {self.weights_file}")
+        else:
+            print(f"No weights file found. Starting fresh.")
+
+    def get_player_name(self):
+        return "LinearQAgent"
@@ -1,188 +1,356 @@
 import math
 import random
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 
 from game_state import GameState
+from playouts import policy_playouts, random_playouts
 from players.player import Player
 from game_action import GameAction
 from typing import Tuple, Dict, List
 from collections import defaultdict
 
 
-class MCTSNode:
-    def __init__(self, state, parent=None):
-        self.state = state  # The game state
-        self.parent = parent  # The parent node
-        self.children = {}  # Map actions to child nodes
-        self.visits = 0  # Number of times this node has been visited
-        self.wins = 0  # Number of simulations this node has won
+class MCTSTree:
+    """
+    The search tree as a struct of arrays: node i is visits[i], wins[i], parent[i], first_child[i],
+    num_children[i] and edge[i] (the line drawn to reach it, -1 for the root). Node 0 is the root. The
+    children of a node are allocated together when it is expanded, so they are the contiguous block
+    first_child .. first_child + num_children, and UCB1 runs over that block in one go.
+
+    Nodes don't keep their GameState: root_state is the only one and positions are rebuilt by playing the
+    edges down from the root. A node costs BYTES_PER_NODE bytes; the arrays start at `capacity` nodes and
+    double when full.
+
+    wins[i] is counted from the side of the player who drew edge[i]. amaf_visits[i] and amaf_wins[i] are
+    the all-moves-as-first (RAVE) statistics of edge[i] at the parent: every simulation through the parent
+    in which the player to move there drew edge[i] at any later point, weighted by the share of its
+    playouts that did.
+    """
+    # visits, wins, parent, first_child, num_children, edge, amaf_visits, amaf_wins
+    BYTES_PER_NODE = 4 + 4 + 4 + 4 + 2 + 2 + 4 + 4
+    FIELDS = ('visits', 'wins', 'parent', 'first_child', 'num_children', 'edge', 'amaf_visits', 'amaf_wins')
+
+    def __init__(self, root_state: GameState, capacity: int = 1024):
+        self.root_state = root_state.copy()
+        self.visits = np.zeros(capacity, dtype=np.int32)
+        self.wins = np.zeros(capacity, dtype=np.float32)
+        self.parent = np.full(capacity, -1, dtype=np.int32)
+        self.first_child = np.full(capacity, -1, dtype=np.int32)
+        self.num_children = np.zeros(capacity, dtype=np.int16)
+        self.edge = np.full(capacity, -1, dtype=np.int16)
+        self.amaf_visits = np.zeros(capacity, dtype=np.float32)
+        self.amaf_wins = np.zeros(capacity, dtype=np.float32)
+        self.size = 1
+
+    def __len__(self):
+        return self.size
+
+    def expand(self, node: int, edges: List[int]):
+        """
+        Give node one (unvisited) child per edge.
+        """
+        start = self._allocate(len(edges))
+        self.first_child[node] = start
+        self.num_children[node] = len(edges)
+        self.parent[start:start + len(edges)] = node
+        self.edge[start:start + len(edges)] = edges
 
-    def is_fully_expanded(self, possible_actions):
-        return len(self.children) == len(possible_actions)
+    def children(self, node: int) -> slice:
+        start = self.first_child[node]
+        return slice(start, start + self.num_children[node])
 
-    def best_child(self, exploration_weight=1.414):
+    def select_child(self, node: int, exploration_weight=1.414, rave_equivalence=0) -> int:
         """
-        Return the child with the highest UCB1 score.
+        An unvisited child if there is one (random, or the best by AMAF value with RAVE), else the child with
+        the highest UCB1 score. With rave_equivalence k > 0 the mean value of a child with n visits is
+        blended with its AMAF value, which gets the weight sqrt(k / (3n + k)).
         """
-        best_score = -float('inf')
-        best_child = None
-        for action, child in self.children.items():
-            exploit = child.wins / child.visits if child.visits > 0 else 0
-            explore = math.sqrt(math.log(self.visits) / child.visits) if child.visits > 0 else float('inf')
-            ucb1_score = exploit + exploration_weight * explore
-            if ucb1_score > best_score:
-                best_score = ucb1_score
-                best_child = (action, child)
-        return best_child
-
-    def expand(self, action, child_node):
+        block = self.children(node)
+        visits = self.visits[block]
+        unvisited = np.flatnonzero(visits == 0)
+        if rave_equivalence:
+            amaf_visits = self.amaf_visits[block]
+            amaf_values = np.divide(self.amaf_wins[block], amaf_visits, out=np.zeros(len(visits), dtype=np.float32),
+                                    where=amaf_visits > 0)
+        if len(unvisited):
+            if rave_equivalence:
+                best = amaf_values[unvisited] == amaf_values[unvisited].max()
+                unvisited = unvisited[best]
+            return block.start + unvisited[random.randrange(len(unvisited))]
+        values = self.wins[block] / visits
+        if rave_equivalence:
+            beta = np.sqrt(rave_equivalence / (3 * visits + rave_equivalence))
+            values = (1 - beta) * values + beta * amaf_values
+        ucb1_scores = values + exploration_weight * np.sqrt(math.log(self.visits[node]) / visits)
+        return block.start + int(np.argmax(ucb1_scores))
+
+    def backpropagate(self, path: List[int], player1_moves: List[bool], reward: float):
         """
-        Add a child node for the given action.
+        Count a simulation with the given reward (player1's side) on every node of path (root first);
+        player1_moves[i] tells whether player1 drew the edge of path[i + 1].
         """
-        self.children[action] = child_node
-
-
-class MCTSPlayer(Player):
-    def __init__(self, simulations=10):
-        super().__init__()
-        self.simulations = simulations  # Number of MCTS simulations to run
-
-    def get_action(self, state: GameState) -> GameAction:
-        root = MCTSNode(state)  # Create the root node for MCTS
+        self.visits[path] += 1
+        signs = np.where(player1_moves, 1, -1)
+        self.wins[path[1:]] += reward * signs
 
-        for _ in range(self.simulations):
-            node = self.selection(root)
-            if not self.is_terminal(node.state):
-                node = self.expansion(node)
-            reward = self.simulation(node.state)
-            self.backpropagation(node, reward)
-
-        # Choose the child with the highest visit count as the best move
-        best_action, _ = max(root.children.items(), key=lambda child: child[1].visits)
-        return best_action
-
-    def selection(self, node: MCTSNode) -> MCTSNode:
+    def backpropagate_amaf(self, path: List[int], player1_moves: List[bool], reward: float, drawn_by: np.ndarray,
+                           outcomes: np.ndarray):
         """
-        Traverse the tree to the most promising node using UCB1.
+        Update the AMAF statistics of the children of every node of path. drawn_by and outcomes are the
+        playouts from the end of path: who drew each line in each of them (1 player1, -1 player2, 0 before
+        the playouts) and their results (player1's side). The lines of path itself count for all of them.
         """
-        while not self.is_terminal(node.state) and node.is_fully_expanded(self.get_possible_actions(node.state)):
-            action, node = node.best_child()
-        return node
-
-    def expansion(self, node: MCTSNode) -> MCTSNode:
+        by_player1 = drawn_by == 1
+        by_player2 = drawn_by == -1
+        # the share of the playouts in which each player drew each line, and their mean result for him
+        shares = {True: by_player1.mean(axis=0), False: by_player2.mean(axis=0)}
+        results = {True: (by_player1 * outcomes[:, None]).mean(axis=0),
+                   False: -(by_player2 * outcomes[:, None]).mean(axis=0)}
+        for i in range(len(player1_moves) - 1, -1, -1):
+            player1 = player1_moves[i]
+            edge = self.edge[path[i + 1]]
+            shares[player1][edge] = 1
+            results[player1][edge] = reward if player1 else -reward
+            block = self.children(path[i])
+            edges = self.edge[block]
+            self.amaf_visits[block] += shares[player1][edges]
+            self.amaf_wins[block] += results[player1][edges]
+
+    def path_edges(self, node: int) -> List[int]:
         """
-        Expand the node by adding one of the untried child states.
+        The edges from the root to node.
         """
-        possible_actions = self.get_possible_actions(node.state)
-        untried_actions = [action for action in possible_actions if action not in node.children]
-
-        # Pick a random untried action
-        action = random.choice(untried_actions)
+        edges = []
+        while node > 0:
+            edges.append(int(self.edge[node]))
+            node = self.parent[node]
+        return edges[::-1]
 
-        # Simulate the action and create a new game state
-        new_state = self.simulate_action(node.state, action.action_type, action.position, node.state.player1_turn)
-        child_node = MCTSNode(new_state, parent=node)
-        node.expand(action, child_node)
+    def subtree(self, node: int, root_state: GameState) -> 'MCTSTree':
+        """
+        A compact copy of the subtree under node (whose position is root_state), with node as its root.
+        """
+        tree = MCTSTree(root_state, capacity=max(1024, self.size))
+        tree.visits[0] = self.visits[node]
+        tree.wins[0] = self.wins[node]
+        tree.amaf_visits[0] = self.amaf_visits[node]
+        tree.amaf_wins[0] = self.amaf_wins[node]
+        stack = [(node, 0)]
+        while stack:
+            old_node, new_node = stack.pop()
+            if self.first_child[old_node] < 0:
+                continue
+            old_block = self.children(old_node)
+            count = old_block.stop - old_block.start
+            start = tree._allocate(count)
+            tree.first_child[new_node] = start
+            tree.num_children[new_node] = count
+            new_block = slice(start, start + count)
+            tree.parent[new_block] = new_node
+            tree.visits[new_block] = self.visits[old_block]
+            tree.wins[new_block] = self.wins[old_block]
+            tree.edge[new_block] = self.edge[old_block]
+            tree.amaf_visits[new_block] = self.amaf_visits[old_block]
+            tree.amaf_wins[new_block] = self.amaf_wins[old_block]
+            for i in np.flatnonzero(self.first_child[old_block] >= 0).tolist():
+                stack.append((old_block.start + i, start + i))
+        return tree
+
+    def _allocate(self, count: int) -> int:
+        start = self.size
+        if start + count > len(self.visits):
+            capacity = max(2 * len(self.visits), start + count)
+            for name in self.FIELDS:
+                old = getattr(self, name)
+                new = np.full(capacity, -1 if name in ('parent', 'first_child', 'edge') else 0, dtype=old.dtype)
+                new[:start] = old[:start]
+                setattr(self, name, new)
+        self.size += count
+        return start
 
-        return child_node
 
-    def simulation(self, state: GameState) -> float:
+class MCTSPlayer(Player):
+    def __init__(self, simulations=10, workers=0, seed=None, playouts=32, time_limit=None, reuse_tree=True,
+                 rollout='heuristic', rave_equivalence=300):
         """
-        Simulate a random playout from the current state until the game ends.
+        rollout: 'heuristic' plays the playouts with playouts.policy_playouts (captures, then safe lines, then
+            sacrifices), 'random' with uniformly random lines.
+        rave_equivalence: the number of visits at which a child's own mean and its AMAF (RAVE) value weigh
+            about the same in selection (see MCTSTree.select_child). 0 disables RAVE.
+        time_limit: seconds per move. When set, simulations run until it is used up instead of stopping
+            after `simulations` of them.
+        reuse_tree: keep the tree between moves and continue from the node of the new position (see
+            reuse_root) instead of starting from an empty tree. Only for the single process search.
+        playouts: random games played (all at once, see playouts.random_playouts) to evaluate each new leaf.
+        workers: number of worker processes. Each one grows its own tree from the root with `simulations`
+            simulations and the visit/win counts of the root children are summed before the move is picked
+            (root parallelization). 0 searches in this process only. The pool is started on the first move
+            and kept until close().
+        seed: makes the worker searches reproducible: worker i searching the n-th move of the player seeds
+            its random stream with (seed, n, i).
         """
-        current_state = state
+        super().__init__()
+        self.simulations = simulations  # Number of MCTS simulations to run
+        self.workers = workers
+        self.seed = seed
+        self.executor = None
+        self.moves_searched = 0
+        self.playouts = playouts
+        self.rng = None
+        self.time_limit = time_limit
+        self.reuse_tree = reuse_tree
+        self.tree = None  # the tree of the last search, kept for reuse_root
+        self.rollout = rollout
+        self.rave_equivalence = rave_equivalence
+        # what a worker process needs to build its own copy of this player
+        self.worker_config = dict(simulations=simulations, playouts=playouts, time_limit=time_limit,
+                                  reuse_tree=False, rollout=rollout, rave_equivalence=rave_equivalence)
 
-        while not self.is_terminal(current_state):
-            possible_actions = self.get_possible_actions(current_state)
-            action = random.choice(possible_actions)  # Play random actions
-            current_state = self.simulate_action(current_state, action.action_type, action.position,
-                                                 current_state.player1_turn)
+    def get_action(self, state: GameState) -> GameAction:
+        self.moves_searched += 1
+        if self.workers:
+            statistics = self.parallel_search(state)
+        else:
+            tree = self.search(state)
+            if self.reuse_tree:
+                self.tree = tree
+            statistics = self.root_statistics(tree)
 
-        # Return the final score (1 for player1 win, -1 for player2 win, 0 for tie)
-        return self.evaluate_terminal_state(current_state)
+        # Choose the child with the highest visit count as the best move
+        best_edge = max(statistics, key=lambda edge: statistics[edge][0])
+        return state.layout.actions[best_edge]
 
-    def backpropagation(self, node: MCTSNode, reward: float):
+    def search(self, state: GameState) -> MCTSTree:
         """
-        Propagate the result of the simulation back up the tree.
+        Grow a tree from state for self.time_limit seconds (or self.simulations simulations) and return it.
+        It continues the previous tree when that one has the position (see reuse_root).
         """
-        while node is not None:
-            node.visits += 1
-            node.wins += reward
-            reward = -reward  # Alternate reward between players
-            node = node.parent
-
-    def simulate_action(self, state: GameState, action_type: str, position: Tuple[int, int],
-                        player1_turn: bool) -> GameState:
+        tree = self.reuse_root(state) if self.reuse_tree else None
+        if tree is None:
+            tree = MCTSTree(state)  # Create the root node for MCTS
+        # the playouts draw from numpy, seeded from random so that seeding random reproduces the search
+        self.rng = np.random.default_rng(random.getrandbits(64))
+        deadline = time.perf_counter() + self.time_limit if self.time_limit is not None else None
+        actions = state.layout.actions
+        # the position of the current node: moves are applied on the way down and undone after each simulation
+        current = tree.root_state.copy()
+
+        simulations = 0
+        while True:
+            # Selection and expansion: follow UCB1 down to the first unvisited node
+            node = 0
+            path = [0]
+            player1_moves = []
+            while not current.is_gameover():
+                if tree.first_child[node] < 0:
+                    tree.expand(node, list(current.free_edges()))
+                node = tree.select_child(node, rave_equivalence=self.rave_equivalence)
+                player1_moves.append(current.player1_turn)
+                current.apply(actions[tree.edge[node]])
+                path.append(node)
+                if tree.visits[node] == 0:
+                    break
+            reward, drawn_by, outcomes = self.simulation(current)
+            tree.backpropagate(path, player1_moves, reward)
+            if self.rave_equivalence:
+                tree.backpropagate_amaf(path, player1_moves, reward, drawn_by, outcomes)
+            for _ in player1_moves:
+                current.undo()
+
+            simulations += 1
+            if deadline is None and simulations >= self.simulations:
+                break
+            if deadline is not None and time.perf_counter() >= deadline:
+                break
+        return tree
+
+    def reuse_root(self, state: GameState):
         """
-        Simulate taking an action in the current state. This function returns a new game state.
+        The subtree of the previous tree under the node for state, or None. The position after our move and
+        the opponent's reply (several lines when boxes give extra turns) is looked for among the nodes
+        reached by drawing, in any order, exactly the lines drawn since, and matched by Zobrist hash and box
+        owners after replaying its path.
         """
-        new_board_status = state.board_status.copy()
-        new_row_status = state.row_status.copy()
-        new_col_status = state.col_status.copy()
-
-        x, y = position
-        playerModifier = 1 if player1_turn else -1
-
-        if action_type == 'row':
-            new_row_status[y][x] = 1
-            if y < len(new_board_status):
-                new_board_status[y][x] += playerModifier
-            if y > 0:
-                new_board_status[y - 1][x] += playerModifier
-
-        elif action_type == 'col':
-            new_col_status[y][x] = 1
-            if x < len(new_board_status[0]):
-                new_board_status[y][x] += playerModifier
-            if x > 0:
-                new_board_status[y][x - 1] += playerModifier
-
-        return GameState(
-            board_status=new_board_status,
-            row_status=new_row_status,
-            col_status=new_col_status,
-            player1_turn=not player1_turn
-        )
-
-    def get_possible_actions(self, state: GameState) -> list:
+        old_tree = self.tree
+        self.tree = None
+        if old_tree is None or old_tree.root_state.layout is not state.layout:
+            return None
+        old_free = set(old_tree.root_state.free_edges())
+        new_free = set(state.free_edges())
+        if not new_free <= old_free:
+            return None
+        drawn = old_free - new_free
+        stack = [(0, 0)]
+        while stack:
+            node, depth = stack.pop()
+            if depth == len(drawn):
+                replayed = old_tree.root_state.copy()
+                for edge in old_tree.path_edges(node):
+                    replayed.apply(state.layout.actions[edge])
+                if replayed.zobrist == state.zobrist and np.array_equal(replayed.board_status, state.board_status):
+                    return old_tree.subtree(node, state)
+                continue
+            if old_tree.first_child[node] >= 0:
+                block = old_tree.children(node)
+                for i in range(block.start, block.stop):
+                    if old_tree.edge[i] in drawn and old_tree.visits[i]:
+                        stack.append((i, depth + 1))
+        return None
+
+    def root_statistics(self, tree: MCTSTree) -> Dict[int, Tuple[int, float]]:
         """
-        Return a list of possible actions given the current game state.
+        edge id -> (visits, wins) of every visited child of the root.
         """
-        possible_actions = []
+        block = tree.children(0)
+        return {int(edge): (int(visits), float(wins))
+                for edge, visits, wins in zip(tree.edge[block], tree.visits[block], tree.wins[block]) if visits}
 
-        for y in range(len(state.row_status)):
-            for x in range(len(state.row_status[0])):
-                if state.row_status[y][x] == 0:
-                    possible_actions.append(GameAction('row', (x, y)))
-
-        for y in range(len(state.col_status)):
-            for x in range(len(state.col_status[0])):
-                if state.col_status[y][x] == 0:
-                    possible_actions.append(GameAction('col', (x, y)))
-
-        return possible_actions
-
-    def is_terminal(self, state: GameState) -> bool:
+    def parallel_search(self, state: GameState) -> Dict[int, Tuple[int, float]]:
         """
-        Check if the game is over.
+        Run one search per worker from the same root and merge the root statistics.
         """
-        return np.all(state.row_status == 1) and np.all(state.col_status == 1)
-
-    def evaluate_terminal_state(self, state: GameState) -> float:
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(self.workers)
+        seed = self.seed if self.seed is not None else random.getrandbits(64)
+        futures = [self.executor.submit(_worker_search, state, self.worker_config,
+                                        f"{seed}/{self.moves_searched}/{worker}")
+                   for worker in range(self.workers)]
+        statistics = {}
+        for future in futures:
+            for edge, (visits, wins) in future.result().items():
+                merged_visits, merged_wins = statistics.get(edge, (0, 0))
+                statistics[edge] = (merged_visits + visits, merged_wins + wins)
+        return statistics
+
+    def close(self):
         """
-        Evaluate the terminal state and return the game outcome.
-        1 for player1 win, -1 for player2 win, and 0 for a tie.
+        Stop the worker processes of parallel_search.
         """
-        player1_score = np.sum(state.board_status == 4)
-        player2_score = np.sum(state.board_status == -4)
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
 
-        if player1_score > player2_score:
-            return 1
-        elif player2_score > player1_score:
-            return -1
-        else:
-            return 0
+    def simulation(self, state: GameState) -> Tuple[float, np.ndarray, np.ndarray]:
+        """
+        Play self.playouts games from the state until they end. Returns the mean outcome, from 1 (player1
+        won them all) to -1 (player2 did), who drew each line in each game and the outcome of each game.
+        """
+        playouts = policy_playouts if self.rollout == 'heuristic' else random_playouts
+        scores, drawn_by = playouts(state, self.playouts, self.rng, return_moves=True)
+        outcomes = np.sign(scores)
+        return float(outcomes.mean()), drawn_by, outcomes
 
     def get_player_name(self) -> str:
         return "MCTSPlayer"
+
+
+def _worker_search(state: GameState, config: dict, seed: str) -> Dict[int, Tuple[int, float]]:
+    """
+    MCTSPlayer.parallel_search worker: one seeded search from state, returning its root statistics.
+    """
+    random.seed(seed)
+    player = MCTSPlayer(**config)
+    return player.root_statistics(player.search(state))
@@ -15,4 +15,9 @@ class Player(ABC):
     def get_player_name(self) -> str:
         pass
 
+    def close(self):
+        """
+        Release what the player holds on to between moves (worker processes). Nothing by default.
+        """
+
 
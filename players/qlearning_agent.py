@@ -5,30 +5,104 @@ import numpy as np
 import random
 from game_action import GameAction
 from players.player import Player
+from edge_layout import get_layout
 from game_state import GameState
+from q_table_file import MappedQTable, board_shape, is_q_table_file, load_pickled_q_table
+from symmetry import get_symmetries
 
 
 class QLearningAgent(Player):
-    def __init__(self, learning_rate=0.1, discount_factor=0.95, epsilon=0.1,q_table_file=None):
+    def __init__(self, learning_rate=0.1, discount_factor=0.95, epsilon=0.1,q_table_file=None, use_symmetry=False,
+                 checkpoint_log=False, compact_every=100, replay_size=0, replay_batch=32, replay_every=4):
+        """
+        use_symmetry: key the Q-table on the representative of the state's symmetry class (see symmetry.py),
+            so the (up to 8) rotations/reflections of a position share one entry.
+        q_table_file: a pickled Q-table, or a memory-mapped one (see q_table_file.py), which is looked up in
+            place instead of being loaded.
+        checkpoint_log: checkpoint() appends the rows changed since the last checkpoint to q_table_file + '.log'
+            instead of saving the whole table, and loading replays that log over the table. Log records are
+            numbered and a snapshot keeps the number of the last one it includes, so records a snapshot
+            already has are never replayed over it.
+        compact_every: with checkpoint_log, every compact_every-th checkpoint saves the whole table and
+            empties the log (save_q_table() does the same, call it on exit).
+        replay_size: capacity of the experience replay buffer, 0 learns from every move once, as it is made.
+            With replay, a transition goes from one of the agent's moves to the next move of the same side
+            (its real successor) or to the end of the game. The reward is the change of the side's score lead
+            in between (the boxes it took minus the boxes the opponent took), plus the end of round reward of
+            the side at the end (see reward). Transitions are kept in preallocated ring buffers, and every
+            replay_every transitions a minibatch of replay_batch of them, drawn at random, is learned from.
+        """
         self.q_table = {}  # A dictionary to store Q-values
+        self.use_symmetry = use_symmetry
         self.learning_rate = learning_rate
         self.q_table_file = q_table_file
         self.discount_factor = discount_factor
         self.epsilon = epsilon
         self.last_state_action = None  # Track the last state-action pair
+        self.checkpoint_log = checkpoint_log
+        self.compact_every = compact_every
+        self.checkpoints = 0
+        self.checkpoint_seq = 0  # number of the last log record written or included in the loaded snapshot
+        self.changed_keys = set()  # keys of the rows changed since the last checkpoint
+        self.replay_size = replay_size
+        self.replay_batch = replay_batch
+        self.replay_every = replay_every
+        if replay_size:
+            # ring buffers of (state key, table action edge, reward, next state key, done); the keys are the
+            # Q-table's own tuples, so the buffers only hold references to them
+            self.replay_states = np.empty(replay_size, dtype=object)
+            self.replay_actions = np.zeros(replay_size, dtype=np.int16)
+            self.replay_rewards = np.zeros(replay_size, dtype=np.float32)
+            self.replay_next_states = np.empty(replay_size, dtype=object)
+            self.replay_done = np.zeros(replay_size, dtype=bool)
+            self.replay_count = 0
+            self.transitions = 0
+            self.replay_rng = np.random.default_rng(random.getrandbits(64))
+            # player1_turn -> (state key, table action edge, score lead) of that side's last move
+            self.pending = {}
+            self.last_free_count = None
         if q_table_file:
             self.load_q_table()
 
     def get_state_key(self, state: GameState):
         """Convert the GameState into a tuple (hashable) to use as a key for Q-table."""
+        return self.canonicalize(state)[0]
+
+    def canonicalize(self, state: GameState):
+        """
+        Returns (key, symmetry): the Q-table key of the state and the symmetry that maps the state's actions
+        to the actions stored under that key (None when use_symmetry is off).
+        """
+        symmetry = None
+        if self.use_symmetry:
+            symmetries = get_symmetries(state.layout)
+            s, _ = symmetries.canonicalize(state)
+            symmetry = (symmetries, s)
+            state = symmetries.transform_state(s, state)
         return (tuple(state.board_status.flatten()),
                 tuple(state.row_status.flatten()),
                 tuple(state.col_status.flatten()),
-                state.player1_turn)
+                state.player1_turn), symmetry
+
+    @staticmethod
+    def to_table_action(action: GameAction, symmetry) -> GameAction:
+        if symmetry is None:
+            return action
+        symmetries, s = symmetry
+        return symmetries.transform_action(s, action)
+
+    @staticmethod
+    def from_table_action(action: GameAction, symmetry) -> GameAction:
+        if symmetry is None:
+            return action
+        symmetries, s = symmetry
+        return symmetries.transform_action(symmetries.inverse(s), action)
 
     def get_action(self, state: GameState) -> GameAction:
         """Decide the next action using an epsilon-greedy policy."""
-        state_key = self.get_state_key(state)
+        state_key, symmetry = self.canonicalize(state)
+        if self.replay_size:
+            return self.get_replay_action(state, state_key, symmetry)
 
         if random.random() < self.epsilon:
             # Exploration: random move
@@ -37,57 +111,233 @@ class QLearningAgent(Player):
         else:
             # Exploitation: choose the best move from Q-table
             if state_key not in self.q_table:
-                self.q_table[state_key] = {action: 0.0 for action in state.get_valid_moves()}
+                self.q_table[state_key] = {self.to_table_action(action, symmetry): 0.0
+                                           for action in state.get_valid_moves()}
+                self.mark_changed(state_key)
 
-            best_action = max(self.q_table[state_key], key=self.q_table[state_key].get)
+            row = self.q_table[state_key]
+            best_action = max(row, key=row.get)
+            best_action = self.from_table_action(best_action, symmetry)
             self.last_state_action = (state, best_action)
             self.reward(self.turn_end_reward(state,state.generate_successor(best_action)))
             return best_action
 
+    def get_replay_action(self, state: GameState, state_key, symmetry) -> GameAction:
+        """
+        get_action with experience replay: close the side's previous transition with this state, pick the
+        move epsilon-greedily and keep it pending until the side moves again or the game ends.
+        """
+        free_count = state.count_valid_moves()
+        if self.last_free_count is not None and free_count > self.last_free_count:
+            self.pending = {}  # a new game started without reward() closing the last one
+        self.last_free_count = free_count
+        if state_key not in self.q_table:
+            self.q_table[state_key] = {self.to_table_action(action, symmetry): 0.0
+                                       for action in state.get_valid_moves()}
+            self.mark_changed(state_key)
+        side = state.player1_turn
+        lead = self.score_lead(state)
+        pending = self.pending.pop(side, None)
+        if pending is not None:
+            last_state_key, edge, last_lead = pending
+            self.store_transition(last_state_key, edge, lead - last_lead, state_key, False)
+
+        if random.random() < self.epsilon:
+            action = random.choice(state.get_valid_moves())
+            table_action = self.to_table_action(action, symmetry)
+        else:
+            row = self.q_table[state_key]
+            table_action = max(row, key=row.get)
+            action = self.from_table_action(table_action, symmetry)
+        edge = state.layout.edge_index(table_action.action_type, table_action.position)
+        self.pending[side] = (state_key, edge, lead)
+        self.last_state_action = (state, action)
+        return action
+
+    def store_transition(self, state_key, edge, reward, next_state_key, done):
+        """
+        Add a transition to the ring buffers (over the oldest one once they are full) and learn from a
+        minibatch every replay_every transitions.
+        """
+        i = self.transitions % self.replay_size
+        self.replay_states[i] = state_key
+        self.replay_actions[i] = edge
+        self.replay_rewards[i] = reward
+        self.replay_next_states[i] = next_state_key
+        self.replay_done[i] = done
+        self.transitions += 1
+        self.replay_count = min(self.replay_count + 1, self.replay_size)
+        if self.transitions % self.replay_every == 0 and self.replay_count >= self.replay_batch:
+            self.replay()
+
+    def replay(self):
+        """
+        Q-learning updates from replay_batch transitions drawn uniformly from the buffers, made one after
+        another on the Q-table's rows (a transition drawn twice is learned from twice).
+        """
+        for i in self.replay_rng.integers(self.replay_count, size=self.replay_batch).tolist():
+            state_key = self.replay_states[i]
+            action = get_layout(*board_shape(state_key)).actions[self.replay_actions[i]]
+            next_state_key = None if self.replay_done[i] else self.replay_next_states[i]
+            self.update_q_key(state_key, action, float(self.replay_rewards[i]), next_state_key)
+
     def update_q_value(self, old_state, action, reward, new_state):
         """Update the Q-value based on the reward and the new state."""
-        old_state_key = self.get_state_key(old_state)
-        new_state_key = self.get_state_key(new_state)
+        old_state_key, old_symmetry = self.canonicalize(old_state)
+        new_state_key, new_symmetry = self.canonicalize(new_state)
 
         if old_state_key not in self.q_table:
-            self.q_table[old_state_key] = {action: 0.0 for action in old_state.get_valid_moves()}
+            self.q_table[old_state_key] = {self.to_table_action(a, old_symmetry): 0.0
+                                           for a in old_state.get_valid_moves()}
         if new_state_key not in self.q_table:
-            self.q_table[new_state_key] = {action: 0.0 for action in new_state.get_valid_moves()}
+            self.q_table[new_state_key] = {self.to_table_action(a, new_symmetry): 0.0
+                                           for a in new_state.get_valid_moves()}
+            self.mark_changed(new_state_key)
 
-        old_q_value = self.q_table[old_state_key][action]
-        max_future_q_value = max(self.q_table[new_state_key].values())
+        self.update_q_key(old_state_key, self.to_table_action(action, old_symmetry), reward, new_state_key)
+
+    def update_q_key(self, old_state_key, action, reward, new_state_key):
+        """
+        update_q_value on Q-table keys (see canonicalize) and a table action, both rows being in the table.
+        new_state_key None is the end of the game, worth nothing more.
+        """
+        row = self.q_table[old_state_key]
+        old_q_value = row[action]
+        max_future_q_value = 0.0 if new_state_key is None else max(self.q_table[new_state_key].values())
 
         # Q-learning formula
         new_q_value = old_q_value + self.learning_rate * (
                 reward + self.discount_factor * max_future_q_value - old_q_value)
-        self.q_table[old_state_key][action] = new_q_value
+        row[action] = new_q_value
+        # store the row back: a MappedQTable hands out copies of its mapped rows and only keeps stored ones
+        self.q_table[old_state_key] = row
+        self.mark_changed(old_state_key)
+
+    def mark_changed(self, state_key):
+        if self.checkpoint_log:
+            self.changed_keys.add(state_key)
 
-    def reward(self, feedback):
-        """At the end of the game, adjust rewards based on win/loss."""
+    def reward(self, feedback, final_state: GameState = None):
+        """
+        At the end of the game, adjust rewards based on win/loss.
+
+        With experience replay, final_state (the finished game) closes the last transition of every side the
+        agent played (both in self play): its reward is the change of the side's score lead since that move
+        plus the end of round reward of the side's own result, worked out from final_state, so feedback
+        isn't used. Without final_state the pending transitions are dropped.
+        """
+        if self.replay_size:
+            pending, self.pending = self.pending, {}
+            self.last_free_count = None
+            if final_state is not None:
+                board = final_state.board_status
+                player1_lead = int(np.sum(board == -4)) - int(np.sum(board == 4))
+                for side, (state_key, edge, last_lead) in pending.items():
+                    lead = player1_lead if side else -player1_lead
+                    result = 'win' if lead > 0 else 'loss' if lead < 0 else 'tie'
+                    self.store_transition(state_key, edge, lead - last_lead + self.round_end_reward(result),
+                                          None, True)
+            return
 
-        # Update the last state-action pair with the final result
+        # Update the last state-action pair with the final result, nothing follows it
         if self.last_state_action is not None:
             last_state, last_action = self.last_state_action
-            self.update_q_value(last_state, last_action, feedback, last_state)
+            key, symmetry = self.canonicalize(last_state)
+            if key not in self.q_table:
+                self.q_table[key] = {self.to_table_action(a, symmetry): 0.0 for a in last_state.get_valid_moves()}
+            self.update_q_key(key, self.to_table_action(last_action, symmetry), feedback, None)
+
+    @property
+    def log_file(self):
+        return self.q_table_file + '.log'
+
+    def checkpoint(self):
+        """
+        Save the Q-values changed since the last checkpoint: with checkpoint_log, append their rows to the
+        log as one pickled {key: row} record, so the cost follows the number of updates and not the size of
+        the table, and compact the log every compact_every checkpoints. Without it, save the whole table.
+        """
+        if not self.checkpoint_log:
+            self.save_q_table()
+            return
+        self.checkpoints += 1
+        if self.checkpoints % self.compact_every == 0:
+            self.save_q_table()
+            return
+        if self.changed_keys:
+            self.checkpoint_seq += 1
+            with open(self.log_file, 'ab') as file:
+                pickle.dump((self.checkpoint_seq, {key: self.q_table[key] for key in self.changed_keys}), file)
+            self.changed_keys.clear()
 
     def save_q_table(self):
-        """Save the Q-table to a file."""
-        with open(self.q_table_file, 'wb') as file:
-            pickle.dump(self.q_table, file)
+        """
+        Save the whole Q-table to a file, in the format it was loaded from (a snapshot), and empty the
+        checkpoint log, which the snapshot includes.
+
+        The snapshot replaces the file at once and records checkpoint_seq, so after a crash at any point the
+        log either still applies to the previous snapshot or only holds records the new one already has.
+        """
+        if isinstance(self.q_table, MappedQTable):
+            self.q_table.save(self.q_table_file, self.checkpoint_seq)
+        else:
+            temp_file = self.q_table_file + '.tmp'
+            with open(temp_file, 'wb') as file:
+                pickle.dump(self.q_table, file)
+                pickle.dump(self.checkpoint_seq, file)
+            os.replace(temp_file, self.q_table_file)
+        if self.checkpoint_log:
+            open(self.log_file, 'wb').close()
+            self.changed_keys.clear()
         print(f"Q-table saved to {self.q_table_file}")
 
     def load_q_table(self):
         """Load the Q-table from a file if it exists."""
         if os.path.exists(self.q_table_file):
-            with open(self.q_table_file, 'rb') as file:
-                self.q_table = pickle.load(file)
+            if is_q_table_file(self.q_table_file):
+                self.q_table = MappedQTable(self.q_table_file)
+                self.checkpoint_seq = self.q_table.checkpoint
+            else:
+                self.q_table, self.checkpoint_seq = load_pickled_q_table(self.q_table_file)
             print(f"Q-table loaded from {self.q_table_file}")
         else:
             print(f"No Q-table file found. Starting fresh.")
+        if self.checkpoint_log and os.path.exists(self.log_file):
+            print(f"{self.replay_log()} checkpoints replayed from {self.log_file}")
+
+    def replay_log(self):
+        """
+        Apply the records of the checkpoint log newer than the loaded snapshot to the table, in order. Older
+        ones are left from a crash between writing a snapshot and emptying the log, and the snapshot has
+        them already. A record cut short by a crash while it was written ends the replay. Returns the number
+        of records applied.
+        """
+        records = 0
+        with open(self.log_file, 'rb') as file:
+            while True:
+                try:
+                    seq, rows = pickle.load(file)
+                except (EOFError, pickle.UnpicklingError, ValueError):
+                    break
+                if seq <= self.checkpoint_seq:
+                    continue
+                for key, row in rows.items():
+                    self.q_table[key] = row
+                self.checkpoint_seq = seq
+                records += 1
+        return records
 
     def get_player_name(self):
         return "QLearningAgent"
 
+    @staticmethod
+    def score_lead(state: GameState):
+        """
+        Boxes of the player to move minus the opponent's.
+        """
+        lead = int(np.sum(state.board_status == -4)) - int(np.sum(state.board_status == 4))
+        return lead if state.player1_turn else -lead
+
     @staticmethod
     def turn_end_reward(state_before: GameState, state_after: GameState):
         """
@@ -0,0 +1,301 @@
+import argparse
+import mmap
+import os
+import pickle
+import struct
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from edge_layout import EdgeLayout, get_layout
+from game_action import GameAction
+
+# File layout, little endian:
+#   HEADER                          magic, version, number of sections, checkpoint
+#   SECTION per section             rows, cols, words, count, offset of the keys in the file
+#   per section, at its offset:
+#     keys    uint64 (words, count), one row per 64 bit word of the keys, most significant word first,
+#             sorted by key, so every row is a contiguous array searchsorted can run on
+#     values  float32 (count, num_edges), the Q-value of every edge, NaN for the edges that have none
+#
+# There is one section per board size (a Q-table trained on several sizes keeps them all). A key packs a
+# QLearningAgent state key (board_status, row_status, col_status, player1_turn) into an integer: 4 bits
+# per box (board_status + 4), 1 bit per edge, 1 bit for the turn.
+#
+# checkpoint is the sequence number of the last QLearningAgent checkpoint log record the table includes.
+# Version 1 files have no checkpoint field (it reads as 0).
+MAGIC = b'DBQTABLE'
+VERSION = 2
+HEADER = struct.Struct('<8sIIQ')
+HEADER_V1 = struct.Struct('<8sII')
+SECTION = struct.Struct('<IIIQQ')
+
+StateKey = Tuple[tuple, tuple, tuple, bool]
+QRow = Dict[GameAction, float]
+
+
+def board_shape(key: StateKey) -> Tuple[int, int]:
+    """
+    (rows, cols) in boxes of the board a state key belongs to.
+    """
+    board, row_status, _, _ = key
+    cols = len(row_status) - len(board)  # (rows + 1) * cols row lines against rows * cols boxes
+    return len(board) // cols, cols
+
+
+def encode_key(key: StateKey) -> int:
+    board, rows, cols, player1_turn = key
+    code = 0
+    for value in board:
+        code = code << 4 | (int(value) + 4)
+    for value in rows + cols:
+        code = code << 1 | int(value)
+    return code << 1 | bool(player1_turn)
+
+
+def decode_key(code: int, layout: EdgeLayout) -> StateKey:
+    """
+    The state key of an encode_key code, with float line and box values like the agent's keys (they
+    compare and hash equal to them).
+    """
+    player1_turn = bool(code & 1)
+    code >>= 1
+    lines = []
+    for _ in range(layout.num_edges):
+        lines.append(float(code & 1))
+        code >>= 1
+    board = []
+    for _ in range(layout.num_boxes):
+        board.append(float((code & 15) - 4))
+        code >>= 4
+    lines.reverse()
+    board.reverse()
+    return tuple(board), tuple(lines[:layout.num_row_edges]), tuple(lines[layout.num_row_edges:]), player1_turn
+
+
+def key_words(layout: EdgeLayout) -> int:
+    return (4 * layout.num_boxes + layout.num_edges + 1 + 63) // 64
+
+
+def is_q_table_file(path: str) -> bool:
+    """
+    Whether path holds a table in this format (and not, for example, a pickled dict).
+    """
+    with open(path, 'rb') as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+class Section:
+    """
+    The sorted keys and the values of the states of one board size.
+    """
+    def __init__(self, layout: EdgeLayout, keys: np.ndarray, values: np.ndarray):
+        self.layout = layout
+        self.keys = keys
+        self.values = values
+        self.words, self.count = keys.shape
+
+    def find(self, code: int) -> int:
+        """
+        Index of the encoded key, -1 if it isn't there.
+        """
+        lo, hi = 0, self.count
+        for i in range(self.words):
+            word = np.uint64((code >> (64 * (self.words - 1 - i))) & 0xFFFFFFFFFFFFFFFF)
+            column = self.keys[i, lo:hi]
+            lo, hi = lo + int(column.searchsorted(word, 'left')), lo + int(column.searchsorted(word, 'right'))
+            if lo == hi:
+                return -1
+        return lo
+
+    def row(self, index: int) -> QRow:
+        values = self.values[index]
+        actions = self.layout.actions
+        return {actions[e]: float(values[e]) for e in np.flatnonzero(~np.isnan(values)).tolist()}
+
+
+class MappedQTable:
+    """
+    A Q-table read from a file written by write_q_table, used by QLearningAgent in place of its dict.
+
+    The file is mapped with mmap and looked up in place: a key is found with one binary search per 64 bit
+    word, and only the row of that key is read. Loading takes no time or heap whatever the size of the
+    table, and every process that opens the same file shares one copy of it in the page cache.
+
+    The mapping is read only. Looking a key up builds a new action -> value dict from the mapped row and
+    keeps nothing, so a process that only reads the table doesn't grow. A row that is stored (the agent
+    stores every row it changes, see QLearningAgent.update_q_key) goes into an overlay dict and is served
+    from there afterwards; save() writes the file back with the overlay merged in.
+    """
+    def __init__(self, path: str):
+        with open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, num_sections = HEADER_V1.unpack_from(self._map)
+        if magic != MAGIC or version not in (1, VERSION):
+            raise ValueError(f"{path} is not a version {VERSION} Q-table file")
+        if version == 1:
+            header_size, self.checkpoint = HEADER_V1.size, 0
+        else:
+            header_size, self.checkpoint = HEADER.size, HEADER.unpack_from(self._map)[3]
+        self.sections: Dict[Tuple[int, int], Section] = {}
+        for i in range(num_sections):
+            rows, cols, words, count, offset = SECTION.unpack_from(self._map, header_size + i * SECTION.size)
+            layout = get_layout(rows, cols)
+            keys = np.frombuffer(self._map, dtype='<u8', count=words * count, offset=offset)
+            values = np.frombuffer(self._map, dtype='<f4', count=count * layout.num_edges,
+                                   offset=offset + keys.nbytes)
+            self.sections[(rows, cols)] = Section(layout, keys.reshape(words, count),
+                                                  values.reshape(count, layout.num_edges))
+        self.overlay: Dict[StateKey, QRow] = {}
+        self.added = 0  # keys of the overlay that aren't mapped
+
+    def find(self, key: StateKey) -> Tuple[Optional[Section], int]:
+        """
+        The section of the key's board size and the index of the key in it (-1 if it isn't there).
+        """
+        section = self.sections.get(board_shape(key))
+        if section is None:
+            return None, -1
+        return section, section.find(encode_key(key))
+
+    def __contains__(self, key: StateKey) -> bool:
+        return key in self.overlay or self.find(key)[1] >= 0
+
+    def __getitem__(self, key: StateKey) -> QRow:
+        row = self.overlay.get(key)
+        if row is None:
+            section, index = self.find(key)
+            if index < 0:
+                raise KeyError(key)
+            row = section.row(index)
+        return row
+
+    def get(self, key: StateKey, default=None) -> Optional[QRow]:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key: StateKey, row: QRow):
+        if key not in self.overlay and self.find(key)[1] < 0:
+            self.added += 1
+        self.overlay[key] = row
+
+    def __len__(self):
+        return sum(section.count for section in self.sections.values()) + self.added
+
+    def save(self, path: str, checkpoint: int = None):
+        """
+        Write the table, with every row of the overlay replacing or adding to the mapped ones, to path
+        (which may be the mapped file itself). checkpoint defaults to the one read from the file.
+        """
+        sections = []
+        added = _to_sections(self.overlay)
+        for shape in self.sections.keys() | added.keys():
+            old, new = self.sections.get(shape), added.get(shape)
+            if old is None or new is None:
+                sections.append(old or new)
+                continue
+            kept = np.ones(old.count, dtype=bool)
+            for code in _codes(new):
+                index = old.find(code)
+                if index >= 0:
+                    kept[index] = False
+            sections.append(Section(old.layout, np.concatenate((old.keys[:, kept], new.keys), axis=1),
+                                    np.concatenate((old.values[kept], new.values))))
+        _write(path, sections, self.checkpoint if checkpoint is None else checkpoint)
+
+    def close(self):
+        self.sections = {}
+        self._map.close()
+
+
+def write_q_table(path: str, table: Dict[StateKey, QRow], checkpoint: int = 0):
+    """
+    Write a QLearningAgent dict Q-table to path in the mapped format.
+    """
+    _write(path, list(_to_sections(table).values()), checkpoint)
+
+
+def load_pickled_q_table(pickle_path: str) -> Tuple[Dict[StateKey, QRow], int]:
+    """
+    A pickled QLearningAgent Q-table (see QLearningAgent.save_q_table) and its checkpoint, pickled after the
+    table (0 for tables saved without one).
+    """
+    with open(pickle_path, 'rb') as file:
+        table = pickle.load(file)
+        try:
+            checkpoint = pickle.load(file)
+        except EOFError:
+            checkpoint = 0
+    return table, checkpoint
+
+
+def convert(pickle_path: str, path: str) -> int:
+    """
+    Convert a pickled QLearningAgent Q-table (see QLearningAgent.save_q_table) to the mapped format.
+    Returns the number of states.
+    """
+    table, checkpoint = load_pickled_q_table(pickle_path)
+    write_q_table(path, table, checkpoint)
+    return len(table)
+
+
+def _to_sections(table: Dict[StateKey, QRow]) -> Dict[Tuple[int, int], Section]:
+    by_shape: Dict[Tuple[int, int], List[Tuple[StateKey, QRow]]] = {}
+    for key, row in table.items():
+        by_shape.setdefault(board_shape(key), []).append((key, row))
+    sections = {}
+    for shape, items in by_shape.items():
+        layout = get_layout(*shape)
+        words = key_words(layout)
+        keys = np.zeros((words, len(items)), dtype='<u8')
+        values = np.full((len(items), layout.num_edges), np.nan, dtype='<f4')
+        for i, (key, row) in enumerate(items):
+            code = encode_key(key)
+            for w in range(words):
+                keys[words - 1 - w, i] = (code >> (64 * w)) & 0xFFFFFFFFFFFFFFFF
+            for action, value in row.items():
+                values[i, layout.edge_index(action.action_type, action.position)] = value
+        sections[shape] = Section(layout, keys, values)
+    return sections
+
+
+def _codes(section: Section) -> List[int]:
+    codes = []
+    for i in range(section.count):
+        code = 0
+        for word in section.keys[:, i].tolist():
+            code = code << 64 | word
+        codes.append(code)
+    return codes
+
+
+def _write(path: str, sections: List[Section], checkpoint: int):
+    offset = HEADER.size + len(sections) * SECTION.size
+    offset += -offset % 8
+    table = []
+    for section in sections:
+        table.append(SECTION.pack(section.layout.rows, section.layout.cols, section.words, section.count, offset))
+        size = section.keys.nbytes + section.values.nbytes
+        offset += size + -size % 8
+    # the old file may be mapped (by this process or others), so the new one replaces it instead of
+    # overwriting it in place
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, VERSION, len(sections), checkpoint))
+        file.write(b''.join(table))
+        for section in sections:
+            file.write(b'\0' * (-file.tell() % 8))
+            order = np.lexsort(section.keys[::-1])  # lexsort sorts on its last key first
+            file.write(np.ascontiguousarray(section.keys[:, order], dtype='<u8').tobytes())
+            file.write(np.ascontiguousarray(section.values[order], dtype='<f4').tobytes())
+    os.replace(temp_path, path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a pickled Q-table to the memory-mapped format")
+    parser.add_argument("pickle_path", help="Q-table saved by QLearningAgent.save_q_table")
+    parser.add_argument("path", help="file to write")
+    args = parser.parse_args()
+    print(f"{convert(args.pickle_path, args.path)} states written to {args.path}")
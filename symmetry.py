@@ -0,0 +1,194 @@
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from bitboard_state import BitboardGameState
+from edge_layout import EdgeLayout
+from game_action import GameAction
+from game_state import GameState
+
+
+class Symmetry:
+    """
+    One symmetry of the board, as permutations of the edge and box ids of an EdgeLayout.
+
+    edge_perm[e]: the edge that edge e is mapped to
+    box_perm[b]: the box that box b is mapped to
+    inverse: index (in BoardSymmetries.symmetries) of the symmetry that undoes this one
+    """
+    def __init__(self, name: str, edge_perm: List[int], box_perm: List[int]):
+        self.name = name
+        self.edge_perm = edge_perm
+        self.box_perm = box_perm
+        self.inverse = None
+        # gather indices: transformed[i] = original[source[i]]
+        self.edge_source = np.argsort(edge_perm)
+        self.box_source = np.argsort(box_perm)
+
+
+class BoardSymmetries:
+    """
+    The symmetries of a board (8 for a square board, 4 for a rectangular one) and helpers to map states
+    and actions to the representative of their symmetry class and back.
+
+    The representative is the transformed position with the smallest edge mask (ties, which only happen
+    for symmetric edge sets, are broken on the box values). Edge masks are permuted with per-byte lookup
+    tables, so canonicalizing costs num_symmetries * num_edges / 8 table lookups.
+    """
+    def __init__(self, layout: EdgeLayout):
+        self.layout = layout
+        width, height = layout.cols, layout.rows
+
+        transforms = [('identity', lambda x, y: (x, y)),
+                      ('flip_x', lambda x, y: (width - x, y)),
+                      ('flip_y', lambda x, y: (x, height - y)),
+                      ('rotate_180', lambda x, y: (width - x, height - y))]
+        if width == height:
+            transforms += [('transpose', lambda x, y: (y, x)),
+                           ('rotate_90', lambda x, y: (width - y, x)),
+                           ('rotate_270', lambda x, y: (y, width - x)),
+                           ('anti_transpose', lambda x, y: (width - y, width - x))]
+
+        self.symmetries: List[Symmetry] = [self._build(name, transform) for name, transform in transforms]
+        for symmetry in self.symmetries:
+            for i, other in enumerate(self.symmetries):
+                if all(other.edge_perm[symmetry.edge_perm[e]] == e for e in range(layout.num_edges)):
+                    symmetry.inverse = i
+                    break
+
+        # _mask_tables[s][chunk][byte]: the transformed bits of edges 8 * chunk .. 8 * chunk + 7
+        # _zobrist_tables[chunk][byte]: the xor of the zobrist keys of those edges
+        self._chunks = (layout.num_edges + 7) // 8
+        self._mask_tables = [self._byte_tables(lambda e, s=symmetry: 1 << s.edge_perm[e], lambda a, b: a | b)
+                             for symmetry in self.symmetries]
+        self._zobrist_tables = self._byte_tables(lambda e: layout.zobrist_keys[e], lambda a, b: a ^ b)
+
+    def _build(self, name, transform) -> Symmetry:
+        layout = self.layout
+
+        def edge_of_dots(p, q):
+            (x1, y1), (x2, y2) = p, q
+            if y1 == y2:
+                return layout.edge_index('row', (min(x1, x2), y1))
+            return layout.edge_index('col', (x1, min(y1, y2)))
+
+        edge_perm = []
+        for action_type, (x, y) in layout.edge_positions:
+            end = (x + 1, y) if action_type == 'row' else (x, y + 1)
+            edge_perm.append(edge_of_dots(transform(x, y), transform(*end)))
+
+        box_perm = []
+        for y in range(layout.rows):
+            for x in range(layout.cols):
+                (x1, y1), (x2, y2) = transform(x, y), transform(x + 1, y + 1)
+                box_perm.append(min(y1, y2) * layout.cols + min(x1, x2))
+        return Symmetry(name, edge_perm, box_perm)
+
+    def _byte_tables(self, value_of_edge, combine):
+        tables = []
+        num_edges = self.layout.num_edges
+        for chunk in range(self._chunks):
+            table = [0] * 256
+            for byte in range(1, 256):
+                low = byte & -byte
+                e = 8 * chunk + low.bit_length() - 1
+                table[byte] = combine(table[byte ^ low], value_of_edge(e)) if e < num_edges else table[byte ^ low]
+            tables.append(table)
+        return tables
+
+    def __len__(self):
+        return len(self.symmetries)
+
+    def transform_edges(self, s: int, edges: int) -> int:
+        """
+        The edge mask after applying symmetry s.
+        """
+        result = 0
+        for table in self._mask_tables[s]:
+            result |= table[edges & 255]
+            edges >>= 8
+        return result
+
+    def canonical_edges(self, edges: int) -> Tuple[int, List[int]]:
+        """
+        The smallest edge mask in the symmetry class, and every symmetry that maps to it.
+        """
+        best = None
+        best_symmetries = []
+        for s in range(len(self.symmetries)):
+            transformed = self.transform_edges(s, edges)
+            if best is None or transformed < best:
+                best = transformed
+                best_symmetries = [s]
+            elif transformed == best:
+                best_symmetries.append(s)
+        return best, best_symmetries
+
+    def canonicalize(self, state: GameState) -> Tuple[int, int]:
+        """
+        Returns (s, edges): the symmetry that maps the state to its class representative and the
+        representative's edge mask.
+        """
+        edges, candidates = self.canonical_edges(state_edges(state))
+        if len(candidates) > 1:
+            board = state.board_status.reshape(-1)
+            candidates.sort(key=lambda s: tuple(board[self.symmetries[s].box_source].tolist()))
+        return candidates[0], edges
+
+    def canonical_zobrist(self, state: GameState) -> Tuple[int, int]:
+        """
+        Returns (s, key): like canonicalize, but with the zobrist hash of the representative (edges and
+        side to move) instead of its edge mask. Meant for search caches.
+        """
+        s, edges = self.canonicalize(state)
+        key = self.layout.zobrist_turn_key if state.player1_turn else 0
+        for table in self._zobrist_tables:
+            key ^= table[edges & 255]
+            edges >>= 8
+        return s, key
+
+    def transform_state(self, s: int, state: GameState) -> GameState:
+        """
+        A new GameState with symmetry s applied to the board.
+        """
+        layout = self.layout
+        symmetry = self.symmetries[s]
+        board = state.board_status.reshape(-1)[symmetry.box_source].reshape(layout.rows, layout.cols)
+        lines = np.concatenate((state.row_status.reshape(-1), state.col_status.reshape(-1)))[symmetry.edge_source]
+        row_status = lines[:layout.num_row_edges].reshape(layout.rows + 1, layout.cols)
+        col_status = lines[layout.num_row_edges:].reshape(layout.rows, layout.cols + 1)
+        return GameState(board, row_status, col_status, state.player1_turn)
+
+    def transform_action(self, s: int, action: GameAction) -> GameAction:
+        layout = self.layout
+        return layout.actions[self.symmetries[s].edge_perm[layout.edge_of(action)]]
+
+    def transform_edge(self, s: int, e: int) -> int:
+        return self.symmetries[s].edge_perm[e]
+
+    def inverse(self, s: int) -> int:
+        return self.symmetries[s].inverse
+
+
+def state_edges(state: GameState) -> int:
+    """
+    The taken edges of a state as an int bitmask (bit e is edge e of the state's EdgeLayout).
+    """
+    if isinstance(state, BitboardGameState):
+        return state.edges
+    taken = np.concatenate((state.row_status.reshape(-1), state.col_status.reshape(-1))) != 0
+    return int.from_bytes(np.packbits(taken, bitorder='little').tobytes(), 'little')
+
+
+_symmetries: Dict[Tuple[int, int], BoardSymmetries] = {}
+
+
+def get_symmetries(layout: EdgeLayout) -> BoardSymmetries:
+    """
+    Return the (cached) symmetries of a layout.
+    """
+    symmetries = _symmetries.get((layout.rows, layout.cols))
+    if symmetries is None:
+        symmetries = BoardSymmetries(layout)
+        _symmetries[(layout.rows, layout.cols)] = symmetries
+    return symmetries
@@ -0,0 +1,77 @@
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List, Tuple
+
+import numpy as np
+
+from match_engine import MatchResult, initial_state, play_game
+
+# The players of a worker process, built once by _init_worker and kept for all the games it plays
+_players = None
+
+
+def seed_game(seed: int, game: int):
+    """
+    Seed the random and numpy generators for one game, so a game plays the same whatever process runs it.
+    """
+    random.seed(f"{seed}/{game}")
+    np.random.seed(random.getrandbits(32))
+
+
+def play_games(player1, player2, number_of_dots: int, games: range, seed: int) -> List[MatchResult]:
+    """
+    Play the given games (indices into the tournament). Player 1 starts the even games, player 2 the odd ones.
+    """
+    results = []
+    for game in games:
+        seed_game(seed, game)
+        results.append(play_game(player1, player2, initial_state(number_of_dots, game % 2 == 0)))
+    return results
+
+
+def run_tournament(create_player: Callable, player1_kwargs: dict, player2_kwargs: dict, number_of_dots: int,
+                   games_num: int, workers: int, seed=0, chunk_size=None) -> Tuple[List[MatchResult], float]:
+    """
+    Play games_num games over a pool of worker processes. Every worker builds its own two players with
+    create_player(**player1_kwargs) and create_player(**player2_kwargs) (a module level function, so it can
+    be sent to the workers) and plays chunks of consecutive games with them.
+
+    Returns the results in game order and the seconds it took.
+
+    Players learn nothing that lasts here: every worker has its own copy, which is dropped at the end.
+    They must not start worker processes of their own (AlphaBetaPlayer/MCTSPlayer with workers > 0): the
+    pool never calls their close(), and a worker doesn't exit while its children run.
+    """
+    if chunk_size is None:
+        chunk_size = max(1, games_num // (workers * 8))
+    chunks = [range(start, min(start + chunk_size, games_num)) for start in range(0, games_num, chunk_size)]
+    start_time = time.time()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(create_player, player1_kwargs, player2_kwargs)) as executor:
+        results = []
+        for chunk_results in executor.map(_play_chunk, chunks, [number_of_dots] * len(chunks),
+                                          [seed] * len(chunks)):
+            results.extend(chunk_results)
+    return results, time.time() - start_time
+
+
+def summary(results: List[MatchResult], elapsed: float) -> List[str]:
+    """
+    Lines reporting the throughput and the mean time per move of each player.
+    """
+    lines = [f"{len(results)} games in {elapsed:.1f}s ({len(results) / elapsed:.1f} games/s)"]
+    for player in (1, 2):
+        moves = sum(getattr(result, f"player{player}_moves") for result in results)
+        seconds = sum(getattr(result, f"player{player}_time") for result in results)
+        lines.append(f"Player {player} mean move latency: {1000 * seconds / max(moves, 1):.3f} ms over {moves} moves")
+    return lines
+
+
+def _init_worker(create_player: Callable, player1_kwargs: dict, player2_kwargs: dict):
+    global _players
+    _players = (create_player(**player1_kwargs), create_player(**player2_kwargs))
+
+
+def _play_chunk(games: range, number_of_dots: int, seed: int) -> List[MatchResult]:
+    return play_games(*_players, number_of_dots, games, seed)
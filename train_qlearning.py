@@ -0,0 +1,281 @@
+import argparse
+import multiprocessing
+import random
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from edge_layout import get_layout
+from game_action import GameAction
+from players.alpha_beta_agent import AlphaBetaPlayer
+from players.player import Player
+from players.qlearning_agent import QLearningAgent
+from players.random_player import RandomPlayer
+from match_engine import initial_state, play_game
+from q_table_file import board_shape, decode_key, encode_key
+
+# One Q-learning update as a worker made it: (old state key, edge id of the table action, reward, new state key).
+# Keys travel between the processes as encode_key codes: the agent's keys are tuples of numpy floats, which
+# take a lot longer to pickle. The end of a game (no new state) is code -1.
+Update = Tuple[int, int, float, int]
+
+OPPONENTS = ("self", "random", "alphabeta")
+
+
+class RecordingQLearningAgent(QLearningAgent):
+    """
+    A worker's agent: learns from its own games like a QLearningAgent and records every update it makes,
+    for the learner to replay on the shared table.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.updates: List[Update] = []
+
+    def update_q_key(self, old_state_key, action, reward, new_state_key):
+        super().update_q_key(old_state_key, action, reward, new_state_key)
+        edge = get_layout(*board_shape(old_state_key)).edge_index(action.action_type, action.position)
+        new_code = -1 if new_state_key is None else encode_key(new_state_key)
+        self.updates.append((encode_key(old_state_key), edge, float(reward), new_code))
+
+
+def new_row(state_key) -> Dict[GameAction, float]:
+    """
+    The row QLearningAgent starts a state with: 0 for every free line of the (table) state.
+    """
+    layout = get_layout(*board_shape(state_key))
+    _, row_status, col_status, _ = state_key
+    lines = row_status + col_status  # indexed by edge id
+    return {layout.actions[e]: 0.0 for e in layout.move_order if not lines[e]}
+
+
+def apply_updates(agent: QLearningAgent, updates: List[Update], board_size: int) -> Dict[int, tuple]:
+    """
+    Replay a worker's updates on the learner's table, in order. Returns the keys whose rows changed, by code.
+    """
+    layout = get_layout(board_size, board_size)
+    changed = {}
+    for old_code, edge, reward, new_code in updates:
+        old_state_key = changed.get(old_code) or decode_key(old_code, layout)
+        if new_code < 0:
+            new_state_key = None
+        else:
+            new_state_key = old_state_key if new_code == old_code else decode_key(new_code, layout)
+        for key in (old_state_key, new_state_key):
+            if key is not None and key not in agent.q_table:
+                agent.q_table[key] = new_row(key)
+                agent.mark_changed(key)
+        agent.update_q_key(old_state_key, layout.actions[edge], reward, new_state_key)
+        changed[old_code] = old_state_key
+    return changed
+
+
+def make_opponent(name: str, depth: int) -> Player:
+    if name == "random":
+        return RandomPlayer()
+    if name == "alphabeta":
+        return AlphaBetaPlayer(depth=depth)
+    raise ValueError(f"Invalid opponent name: {name}")
+
+
+def play_training_game(agent: QLearningAgent, opponent: Player, board_size: int, game: int) -> int:
+    """
+    Play one game without a renderer and give the agent its end of round reward. opponent None is self play.
+    The agent's seat and the first player alternate over consecutive games. Returns 1, -1 or 0 when the
+    agent won, lost or tied (always 0 in self play).
+    """
+    agent_is_player1 = game % 2 == 0
+    agent.last_state_action = None
+    if opponent is None:
+        player1 = player2 = agent
+    else:
+        player1, player2 = (agent, opponent) if agent_is_player1 else (opponent, agent)
+    final_state = initial_state(board_size + 1, (game // 2) % 2 == 0)
+    result = play_game(player1, player2, final_state)
+
+    player1_score, player2_score = result.player1_score, result.player2_score
+    if opponent is None:
+        # the end of round reward goes to the last update, from the side of the player who made it
+        if agent.last_state_action is not None:
+            agent_is_player1 = agent.last_state_action[0].player1_turn
+        outcome = 0
+    else:
+        outcome = int(np.sign(player1_score - player2_score))
+    side = 1 if agent_is_player1 else -1
+    result = np.sign(player1_score - player2_score) * side
+    agent.reward(agent.round_end_reward('win' if result > 0 else 'loss' if result < 0 else 'tie'), final_state)
+    return outcome * side
+
+
+def _worker(worker: int, config: dict, tasks, results):
+    """
+    Worker process loop: get (number of games, rows to sync by key code), overwrite the local rows with the
+    learner's, play the games and send back the updates made.
+    """
+    layout = get_layout(config['board_size'], config['board_size'])
+    random.seed(f"{config['seed']}/{worker}")
+    agent = RecordingQLearningAgent(**config['agent'])
+    agent.checkpoint_log = False  # the learner writes the table, this copy only plays
+    opponent = None if config['opponent'] == "self" else make_opponent(config['opponent'], config['depth'])
+    game = worker
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        games, rows = task
+        for code, row in rows.items():
+            agent.q_table[decode_key(code, layout)] = row
+        outcomes = []
+        for _ in range(games):
+            outcomes.append(play_training_game(agent, opponent, config['board_size'], game))
+            game += 1
+        results.put((worker, agent.updates, outcomes))
+        agent.updates = []
+
+
+class Trainer:
+    """
+    Headless Q-learning training: worker processes play QLearningAgent games (self play or against an
+    opponent) with their own copy of the table and send the updates they made to the learner (this
+    process), which replays them on the shared table in the order they arrive. Each time a worker reports,
+    it gets the next batch of games together with the rows the learner changed since that worker's last
+    batch, so the copies follow the shared table one batch behind.
+
+    The learner checkpoints the table after every batch and writes a full snapshot every snapshot_every
+    games (see QLearningAgent.checkpoint / save_q_table).
+
+    workers: number of worker processes, 0 plays the games in this process on the learner's table.
+    batch_games: games a worker plays between two syncs with the learner.
+    """
+    def __init__(self, q_table_file: str, board_size=3, opponent="self", workers=0, batch_games=50,
+                 snapshot_every=1000, report_every=1000, depth=2, seed=0, **agent_kwargs):
+        if opponent not in OPPONENTS:
+            raise ValueError(f"Invalid opponent name: {opponent}")
+        self.q_table_file = q_table_file
+        self.board_size = board_size
+        self.opponent = opponent
+        self.workers = workers
+        self.batch_games = batch_games
+        self.snapshot_every = snapshot_every
+        self.report_every = report_every
+        self.depth = depth
+        self.seed = seed
+        self.agent_kwargs = agent_kwargs
+        self.agent = QLearningAgent(q_table_file=q_table_file, **agent_kwargs)
+        self.games_played = 0
+        self.outcomes = [0, 0, 0]  # losses, ties, wins of the agent
+        self.start_time = None
+
+    def train(self, games: int):
+        self.start_time = time.time()
+        next_snapshot = self.snapshot_every
+        next_report = self.report_every
+        if self.workers:
+            batches = self._train_parallel(games)
+        else:
+            batches = self._train_here(games)
+        saved = reported = False
+        for _ in batches:
+            reported = self.games_played >= next_report
+            if reported:
+                self.report()
+                next_report += self.report_every
+            saved = self.games_played >= next_snapshot
+            if saved:
+                self.agent.save_q_table()
+                next_snapshot += self.snapshot_every
+            elif self.agent.checkpoint_log:
+                self.agent.checkpoint()
+        # unless the last batch just did it
+        if not saved:
+            self.agent.save_q_table()
+        if not reported:
+            self.report()
+
+    def report(self):
+        elapsed = time.time() - self.start_time
+        losses, ties, wins = self.outcomes
+        record = "" if self.opponent == "self" else f", {wins} wins {losses} losses {ties} ties"
+        print(f"{self.games_played} games in {elapsed:.1f}s ({self.games_played / elapsed:.1f} games/s), "
+              f"{len(self.agent.q_table)} states{record}")
+
+    def _count(self, outcomes: List[int]):
+        self.games_played += len(outcomes)
+        for outcome in outcomes:
+            self.outcomes[outcome + 1] += 1
+
+    def _train_here(self, games: int):
+        random.seed(f"{self.seed}/learner")
+        opponent = None if self.opponent == "self" else make_opponent(self.opponent, self.depth)
+        while self.games_played < games:
+            batch = min(self.batch_games, games - self.games_played)
+            self._count([play_training_game(self.agent, opponent, self.board_size, self.games_played + i)
+                         for i in range(batch)])
+            yield
+
+    def _train_parallel(self, games: int):
+        config = dict(agent=dict(q_table_file=self.q_table_file, **self.agent_kwargs), opponent=self.opponent,
+                      depth=self.depth, board_size=self.board_size, seed=self.seed)
+        # the workers load the snapshot, so it has to include everything the checkpoint log holds
+        if self.agent.checkpoint_log:
+            self.agent.save_q_table()
+        results = multiprocessing.Queue()
+        task_queues = [multiprocessing.Queue() for _ in range(self.workers)]
+        processes = [multiprocessing.Process(target=_worker, args=(w, config, task_queues[w], results), daemon=True)
+                     for w in range(self.workers)]
+        for process in processes:
+            process.start()
+        stale = [{} for _ in range(self.workers)]  # code -> key of the rows changed since the worker's last sync
+        assigned = 0
+        try:
+            for w in range(self.workers):
+                batch = min(self.batch_games, games - assigned)
+                if batch:
+                    task_queues[w].put((batch, {}))
+                    assigned += batch
+            while self.games_played < assigned:
+                worker, updates, outcomes = results.get()
+                changed = apply_updates(self.agent, updates, self.board_size)
+                for keys in stale:
+                    keys.update(changed)
+                self._count(outcomes)
+                batch = min(self.batch_games, games - assigned)
+                if batch:
+                    rows = {code: dict(self.agent.q_table[key]) for code, key in stale[worker].items()}
+                    stale[worker].clear()
+                    task_queues[worker].put((batch, rows))
+                    assigned += batch
+                yield
+        finally:
+            for queue in task_queues:
+                queue.put(None)
+            for process in processes:
+                process.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train a Q-learning agent without a renderer")
+    parser.add_argument("q_table", help="Q-table to train, pickled or memory-mapped (created if missing)")
+    parser.add_argument("-s", "--board_size", type=int, default=3)
+    parser.add_argument("-n", "--games_num", type=int, default=10000)
+    parser.add_argument("--opponent", default="self", help="Choose from: self, random, alphabeta")
+    parser.add_argument("--depth", type=int, default=2, help="search depth of the alphabeta opponent")
+    parser.add_argument("--workers", type=int, default=0, help="worker processes, 0 trains in this process")
+    parser.add_argument("--batch_games", type=int, default=50, help="games a worker plays between syncs")
+    parser.add_argument("--snapshot_every", type=int, default=1000, help="games between full snapshots")
+    parser.add_argument("--report_every", type=int, default=1000, help="games between throughput reports")
+    parser.add_argument("--checkpoint_log", action="store_true",
+                        help="log the Q-values changed by each batch between snapshots")
+    parser.add_argument("--symmetry", action="store_true", help="share Q-table entries between symmetric positions")
+    parser.add_argument("--epsilon", type=float, default=0.1)
+    parser.add_argument("--replay_size", type=int, default=0,
+                        help="experience replay buffer size of the agent, 0 learns from every move once")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    trainer = Trainer(args.q_table, board_size=args.board_size, opponent=args.opponent, workers=args.workers,
+                      batch_games=args.batch_games, snapshot_every=args.snapshot_every,
+                      report_every=args.report_every, depth=args.depth, seed=args.seed, epsilon=args.epsilon,
+                      use_symmetry=args.symmetry, checkpoint_log=args.checkpoint_log,
+                      replay_size=args.replay_size)
+    trainer.train(args.games_num)
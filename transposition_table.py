@@ -0,0 +1,69 @@
+import numpy as np
+
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+
+class TranspositionTable:
+    """
+    Fixed size cache of alpha-beta results keyed by GameState.zobrist.
+
+    Every entry keeps the full key, the searched depth, the bound type (EXACT, LOWER or UPPER), the value
+    and the best edge id (-1 if none). The table is direct mapped (slot = key & mask) and is stored in
+    numpy arrays, so it takes exactly ENTRY_BYTES per slot and never grows past size_mb.
+
+    Replacement: a slot is overwritten when it is empty, holds a result from an older search (see
+    new_search()) or holds a result searched to the same depth or shallower.
+    """
+    ENTRY_BYTES = 8 + 8 + 1 + 1 + 2 + 1  # key, value, depth, flag, move, generation
+
+    def __init__(self, size_mb: float = 16):
+        slots = max(1, int(size_mb * 2 ** 20) // self.ENTRY_BYTES)
+        slots = 1 << (slots.bit_length() - 1)  # round down to a power of two
+        self.mask = slots - 1
+        self.keys = np.zeros(slots, dtype=np.uint64)
+        self.values = np.zeros(slots, dtype=np.float64)
+        self.depths = np.full(slots, -1, dtype=np.int8)
+        self.flags = np.zeros(slots, dtype=np.int8)
+        self.moves = np.full(slots, -1, dtype=np.int16)
+        self.generations = np.zeros(slots, dtype=np.uint8)
+        self.generation = 0
+        self.probes = 0
+        self.hits = 0
+
+    def __len__(self):
+        return self.mask + 1
+
+    def new_search(self):
+        """
+        Mark everything stored so far as old, so it is replaced first.
+        """
+        self.generation = (self.generation + 1) & 0xFF
+
+    def clear(self):
+        self.depths.fill(-1)
+        self.moves.fill(-1)
+
+    def probe(self, key: int):
+        """
+        Returns (depth, flag, value, move) stored for the key, or None.
+        """
+        self.probes += 1
+        slot = key & self.mask
+        if self.depths[slot] < 0 or self.keys[slot].item() != key:
+            return None
+        self.hits += 1
+        return self.depths[slot].item(), self.flags[slot].item(), self.values[slot].item(), self.moves[slot].item()
+
+    def store(self, key: int, depth: int, flag: int, value: float, move: int):
+        slot = key & self.mask
+        stored_depth = self.depths[slot]
+        if stored_depth >= 0 and self.generations[slot] == self.generation and stored_depth > depth:
+            return
+        self.keys[slot] = key
+        self.depths[slot] = depth
+        self.flags[slot] = flag
+        self.values[slot] = value
+        self.moves[slot] = move
+        self.generations[slot] = self.generation